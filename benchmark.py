@@ -0,0 +1,310 @@
+# Benchmark harness for the matcher and the corpus loading, so that speedups
+# (and regressions) can be measured rather than eyeballed.
+#
+# For each (supplement, XML) pair it records the wall time and peak memory of
+# the lookup, flatten and match phases, along with the matcher's own counts.
+# The pairs come from a reproducible synthetic suite built to exercise heavy
+# ellipsis backtracking, plus, if a supplement is given, its real sections
+# checked against the official XML.
+#
+#   python benchmark.py run --json new.json [--csv new.csv] [--supplement "Code & Regs.txt"]
+#   python benchmark.py compare old.json new.json
+
+import argparse
+import copy
+import csv
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import irc, treasregs, utils
+
+PHASES = ["lookup", "flatten", "match"]
+
+CSV_FIELDS = ["name", "kind", "success", "xml_len", "supp_len", "ellipses",
+              "match_attempts", "pairs_tried"] + \
+             [phase + "_s" for phase in PHASES] + [phase + "_peak_bytes" for phase in PHASES]
+
+
+# Runs one of the matchers, returning success, its count of match attempts
+# and the number of (supplement index, XML index) pairs it tried
+def run_matcher(matcher:str, supp_str:str, xml_str:str) -> (bool, int, int):
+    dual_indexes_tried = {}
+    fail_start_idx_ellipsis = {}
+    if matcher == "recursive":
+        success, num_attempts = utils.recursive_match(supp_str, 0, xml_str, 0,
+                                                      dual_indexes_tried, fail_start_idx_ellipsis)
+    else:
+        success, num_attempts, _ = utils.ellipsis_match(supp_str, xml_str,
+                                                        dual_indexes_tried, fail_start_idx_ellipsis)
+    return success, num_attempts, len(dual_indexes_tried)
+
+
+# Returns the result of calling fn, its best wall time over repeat calls,
+# and the peak memory it allocated (measured in a separate, traced call, so
+# that tracing does not distort the timing)
+def measure(fn, repeat:int):
+    best_time = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best_time = elapsed if best_time is None else min(best_time, elapsed)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, best_time, peak
+
+
+# Returns the reproducible synthetic suite as (name, supplement string, XML
+# string) triples.  The XML is drawn from a tiny vocabulary, so every literal
+# segment of the supplement occurs at many offsets, which is what makes
+# ellipsis matching expensive.
+def synthetic_cases(seed:int = 26, scale:int = 1) -> list:
+    rng = random.Random(seed)
+    vocabulary = ["the", "tax", "of", "a", "(a)", "(1)", "income", "shall", "-", "section"]
+    cases = []
+
+    words = [rng.choice(vocabulary) for _ in range(2000 * scale)]
+    xml_str = " ".join(words)
+    cases.append(("exact-long", xml_str, xml_str))
+
+    for step, keep in [(40, 4), (15, 2), (6, 1)]:
+        chunks = [" ".join(words[i:i+keep]) for i in range(0, len(words) - step, step)]
+        supp_str = " … ".join(chunks) + " … " + " ".join(words[-3:])
+        cases.append(("ellipses-every-%d-words" % step, supp_str, xml_str))
+        # the same, but ending in a word that is nowhere in the XML, so that
+        # the final segment fails at once
+        cases.append(("ellipses-every-%d-words-failing" % step, supp_str + " zzz", xml_str))
+
+    repeated = " ".join(["a b"] * (1000 * scale)) + " c"
+    cases.append(("repeated-final-segment", "a … a b c", repeated))
+    cases.append(("repeated-final-segment-failing", "a … a b d", repeated))
+    # a long final segment that matches a long way from each of many anchors
+    # before failing at its last character, which is quadratic if every
+    # anchor is run forward
+    long_segment = " ".join(["a b"] * (200 * scale))
+    cases.append(("long-final-segment-failing", "a … " + long_segment + " c",
+                  " ".join(["a b"] * (2000 * scale)) + " d"))
+    cases.append(("long-final-segment-near-miss", "a … " + long_segment + " c",
+                  " ".join(["a b"] * (2000 * scale)) + " x c"))
+    # the same for a segment between ellipses, which is run forward from
+    # every anchor, so the time grows with the length of the XML times the
+    # length of the segment
+    for length in [1000, 4000]:
+        cases.append(("long-middle-segment-failing-%d" % length, "x … " + long_segment + " c … z",
+                      "x " + " ".join(["a b"] * (length * scale)) + " z"))
+    cases.append(("leading-trailing-ellipses", "… " + " ".join(words[500:520]) + " …", xml_str))
+    return cases
+
+
+# Benchmarks the synthetic suite.  There is no corpus behind these cases, so
+# only the match phase is measured.
+def run_synthetic(matcher:str, repeat:int, seed:int, scale:int) -> list:
+    records = []
+    for name, supp_str, xml_str in synthetic_cases(seed, scale):
+        (success, num_attempts, pairs_tried), match_s, match_peak = \
+            measure(lambda: run_matcher(matcher, supp_str, xml_str), repeat)
+        records.append({"name": "synthetic/" + name, "kind": "synthetic", "success": success,
+                        "xml_len": len(xml_str), "supp_len": len(supp_str),
+                        "ellipses": supp_str.count("…"),
+                        "match_attempts": num_attempts, "pairs_tried": pairs_tried,
+                        "lookup_s": 0.0, "flatten_s": 0.0, "match_s": match_s,
+                        "lookup_peak_bytes": 0, "flatten_peak_bytes": 0, "match_peak_bytes": match_peak})
+        print("{:45s} {:5s} {:9.4f}s".format(name, str(success), match_s), file=sys.stderr)
+    return records
+
+
+# Returns {lowercased identifier: section element} for the given IRC
+# sections, read from the XML just as IRC_records_from_xml reads it
+def IRC_section_elements(sec_nums:list) -> dict:
+    wanted = set("/us/usc/t26/s" + sec_num.lower() for sec_num in sec_nums)
+    section_tag = '{' + irc.usc_ns_str + '}section'
+    elements = {}
+    for outermost in utils.iterparse_outermost(irc.IRC_XML_PATH, section_tag):
+        for s in outermost.iter(section_tag):
+            identifier = s.attrib.get("identifier", "").lower()
+            if identifier in wanted and identifier not in elements:
+                elements[identifier] = copy.deepcopy(s) # outlives the parse
+    return elements
+
+
+# Returns {standardized section number: SECTION element} for the given Treas
+# Reg sections, read from the volumes holding them just as
+# TR_records_from_xml reads them
+def TR_section_elements(sec_nums:list) -> dict:
+    wanted = set(utils.standardize(sec_num) for sec_num in sec_nums)
+    filenames = set(filename for sec_num in wanted for filename in treasregs.tr_index.get(sec_num, []))
+    elements = {}
+    for filename in sorted(filenames):
+        for outermost in utils.iterparse_outermost(treasregs.TR_XML_DIR + "/" + filename,
+                                                   "SECTION", within_tag="TITLE"):
+            for s in outermost.iter("SECTION"):
+                sectno = s.find("SECTNO")
+                if sectno is None or sectno.text is None:
+                    continue
+                s_num, is_multi = treasregs.TR_section_key(sectno.text)
+                if s_num in wanted and not is_multi and s_num not in elements:
+                    elements[s_num] = copy.deepcopy(s)
+    return elements
+
+
+# Returns the standardized heading and text of an IRC section element, as the
+# corpus cache builds them
+def flatten_IRC(s) -> (str, str):
+    heading = s.find('usc:heading', irc.ns)
+    heading_text = utils.standardize(heading.text).strip(".") if heading is not None and heading.text else ""
+    return heading_text, utils.standardize(irc.get_IRC_text_recursive(s))
+
+
+# Returns the standardized heading and text of a Treas Reg SECTION element,
+# as the corpus cache builds them, with the known typos fixed
+def flatten_TR(sec_num:str, s) -> (str, str):
+    subject = s.find("SUBJECT")
+    heading_text = utils.standardize(subject.text).strip(".") if subject is not None and subject.text else ""
+    return treasregs.TR_xml_texts(sec_num, heading_text, utils.standardize(treasregs.get_TR_text_recursive(s)))
+
+
+# Benchmarks every IRC and Treas Reg section of the supplement against the
+# official XML.  The corpora are loaded first, and their load times returned
+# separately, so that lookups measure the index rather than the loading.
+# The sections' XML elements are also read up front, so that the flatten
+# phase measures turning a section's XML into the text checked, as happens
+# for each section whenever the corpus cache is built.
+def run_supplement(path:str, matcher:str, repeat:int) -> (list, dict):
+    import codecheck # only needed for splitting the supplement into sections
+
+    to_check = []
+    with open(path, "r") as f:
+        for header, body in codecheck.iter_sections(f):
+            lines = [utils.standardize(l) for l in [header] + body]
+            sec_num, _, kind = codecheck.parse_header(lines)
+            if kind != "special":
+                to_check.append((kind, sec_num, lines))
+
+    load_times = {}
+    start = time.perf_counter()
+    irc.load_IRC()
+    load_times["irc_load_s"] = time.perf_counter() - start
+    start = time.perf_counter()
+    treasregs.preload_TR([sec_num for kind, sec_num, _ in to_check if kind == "treasreg"])
+    load_times["treasreg_load_s"] = time.perf_counter() - start
+    start = time.perf_counter()
+    irc_elements = IRC_section_elements([sec_num for kind, sec_num, _ in to_check if kind == "irc"])
+    tr_elements = TR_section_elements([sec_num for kind, sec_num, _ in to_check if kind == "treasreg"])
+    load_times["section_xml_s"] = time.perf_counter() - start
+
+    records = []
+    for kind, sec_num, lines in to_check:
+        if kind == "treasreg":
+            sec_num = utils.standardize(sec_num)
+            find_section = lambda: treasregs.find_TreasReg_section(sec_num)
+            element = tr_elements.get(sec_num)
+            flatten = lambda: flatten_TR(sec_num, element)
+        else:
+            find_section = lambda: irc.lookup_IRC(sec_num)
+            element = irc_elements.get("/us/usc/t26/s" + sec_num.lower())
+            flatten = lambda: flatten_IRC(element)
+
+        section, lookup_s, lookup_peak = measure(find_section, repeat)
+        if section is None or element is None:
+            continue # missing from the XML; codecheck.py reports these
+        (_, xml_str), flatten_s, flatten_peak = measure(flatten, repeat)
+        supp_str = utils.process_supp_lines(lines, sec_num)
+        (success, num_attempts, pairs_tried), match_s, match_peak = \
+            measure(lambda: run_matcher(matcher, supp_str, xml_str), repeat)
+        records.append({"name": kind + "/" + sec_num, "kind": kind, "success": success,
+                        "xml_len": len(xml_str), "supp_len": len(supp_str),
+                        "ellipses": supp_str.count("…"),
+                        "match_attempts": num_attempts, "pairs_tried": pairs_tried,
+                        "lookup_s": lookup_s, "flatten_s": flatten_s, "match_s": match_s,
+                        "lookup_peak_bytes": lookup_peak, "flatten_peak_bytes": flatten_peak,
+                        "match_peak_bytes": match_peak})
+        print("{:45s} {:5s} {:9.4f}s".format(kind + "/" + sec_num, str(success), match_s), file=sys.stderr)
+    return records, load_times
+
+
+# Returns a list of regressions from old_report to new_report: cases whose
+# verdict changed, or whose time or peak memory in some phase grew by more
+# than the threshold factor (ignoring growth too small to be more than noise)
+def compare(old_report:dict, new_report:dict, threshold:float,
+            min_seconds:float = 0.001, min_bytes:int = 64 * 1024) -> list:
+    old_cases = {record["name"]: record for record in old_report["cases"]}
+    regressions = []
+    for new in new_report["cases"]:
+        old = old_cases.get(new["name"])
+        if old is None:
+            continue
+        if old["success"] != new["success"]:
+            regressions.append((new["name"], "success", old["success"], new["success"]))
+        for phase in PHASES:
+            for field, minimum in [(phase + "_s", min_seconds), (phase + "_peak_bytes", min_bytes)]:
+                if new[field] > old[field] * threshold and new[field] - old[field] > minimum:
+                    regressions.append((new["name"], field, old[field], new[field]))
+    return regressions
+
+
+def write_csv(path:str, records:list):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the matcher and corpus loading.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the benchmark suite")
+    run_parser.add_argument("--supplement",
+                            help="also benchmark the real sections of this supplement")
+    run_parser.add_argument("--matcher", choices=["ellipsis", "recursive"], default="ellipsis",
+                            help="matcher to benchmark (default: %(default)s)")
+    run_parser.add_argument("--repeat", type=int, default=3,
+                            help="timed runs per phase; the best is kept (default: %(default)s)")
+    run_parser.add_argument("--seed", type=int, default=26,
+                            help="seed for the synthetic suite (default: %(default)s)")
+    run_parser.add_argument("--scale", type=int, default=1,
+                            help="size multiplier for the synthetic suite (default: %(default)s)")
+    run_parser.add_argument("--json", help="write the report as JSON to this file")
+    run_parser.add_argument("--csv", help="write the per-case table as CSV to this file")
+
+    compare_parser = subparsers.add_parser("compare", help="flag regressions between two JSON reports")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=1.25,
+                                help="factor of growth that counts as a regression (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        records = run_synthetic(args.matcher, args.repeat, args.seed, args.scale)
+        load_times = {}
+        if args.supplement is not None:
+            supplement_records, load_times = run_supplement(args.supplement, args.matcher, args.repeat)
+            records += supplement_records
+        report = {"matcher": args.matcher, "seed": args.seed, "scale": args.scale,
+                  "python": platform.python_version(), "load": load_times, "cases": records}
+        if args.json is not None:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=1)
+        if args.csv is not None:
+            write_csv(args.csv, records)
+        print("Total match time = {:.4f}s over {} cases".format(
+            sum(record["match_s"] for record in records), len(records)))
+    else:
+        with open(args.old) as f:
+            old_report = json.load(f)
+        with open(args.new) as f:
+            new_report = json.load(f)
+        regressions = compare(old_report, new_report, args.threshold)
+        for name, field, old_value, new_value in regressions:
+            print("REGRESSION {:40s} {:20s} {} -> {}".format(name, field, old_value, new_value))
+        print("Total regressions =", len(regressions))
+        sys.exit(1 if len(regressions) > 0 else 0)
@@ -0,0 +1,227 @@
+# A long-running server that checks one section at a time, e.g., as it is
+# being edited, without starting Python and loading the corpus for each check.
+# The IRC and every Treas Reg volume are loaded once and kept in memory, and
+# are reloaded in the background whenever usc26.xml or the CFR-title-26
+# volumes change on disk.
+#
+#   python checkserver.py [--host 127.0.0.1] [--port 8026] [--unix-socket PATH]
+#
+# POST /check with a JSON body such as
+#   {"header": "§ 61. Gross income defined", "lines": ["(a) General definition ...", ...]}
+# returns a JSON object with the section's "kind" and "sec_num", the
+# "verdict" ("success", "failure", "not found" or "special"), any
+# "heading_mismatch", where any "failure" is, the "perf_data" entries and the
+# checker's printed "output".  GET /status describes the loaded corpus.  Any
+# error is returned as a JSON object with an "error": status 400 for a bad
+# request (such as a header with no title yet) and 500 for a failed check.
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+import codecheck, corpuscache, irc, treasregs, utils
+
+# Largest request body accepted
+MAX_BODY_BYTES = 16 * 1024 * 1024
+
+# The corpus is only ever used from this one thread, so that checks never
+# see it half reloaded (and checks would not run faster in parallel threads)
+corpus_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+# What is loaded: the signature of each corpus file, and when it was loaded
+corpus_state = {"signatures": None, "loaded_at": None, "num_checks": 0}
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large",
+                500: "Internal Server Error"}
+
+
+# Returns the signature (size and mtime) of each XML file making up the corpus
+def corpus_signatures() -> dict:
+    signatures = {irc.IRC_XML_PATH: corpuscache.source_signature(irc.IRC_XML_PATH)}
+    for filename in os.listdir(treasregs.TR_XML_DIR):
+        path = treasregs.TR_XML_DIR + "/" + filename
+        signatures[path] = corpuscache.source_signature(path)
+    return signatures
+
+
+# Reads the whole corpus afresh, without touching the loaded one, returning
+# what swap_corpus needs.  Runs in the default executor, so that checks go on
+# against the loaded corpus meanwhile.  Progress goes to stderr, as the
+# standard output may be redirected into the output of a check in progress.
+def read_corpus() -> dict:
+    signatures = corpus_signatures()
+    irc_corpus, irc_index = irc.read_IRC()
+    tr_volumes = {}
+    tr_index, tr_multi_section_index = treasregs.read_TR_index(tr_volumes, progress=sys.stderr)
+    for filename in os.listdir(treasregs.TR_XML_DIR):
+        if filename not in tr_volumes:
+            tr_volumes[filename] = treasregs.read_TR_volume(filename)
+    return {"signatures": signatures, "irc": (irc_corpus, irc_index),
+            "tr": (tr_index, tr_multi_section_index, tr_volumes)}
+
+
+# Makes a corpus from read_corpus the loaded one.  Runs on corpus_executor,
+# so between checks.
+def swap_corpus(corpus:dict):
+    irc.irc_corpus, irc.irc_index = corpus["irc"]
+    treasregs.tr_index, treasregs.tr_multi_section_index, treasregs.tr_volumes = corpus["tr"]
+    corpus_state["signatures"] = corpus["signatures"]
+    corpus_state["loaded_at"] = time.time()
+
+
+# Reads the whole corpus and, only once that has succeeded, swaps it in
+async def load_corpus():
+    loop = asyncio.get_running_loop()
+    corpus = await loop.run_in_executor(None, read_corpus)
+    await loop.run_in_executor(corpus_executor, swap_corpus, corpus)
+
+
+# Checks one section, returning the response.  Runs on corpus_executor.
+def check_section(header:str, lines:list) -> dict:
+    report = {}
+    output, perf_data, _ = codecheck.check_lines_captured([header] + lines, report)
+    report["perf_data"] = [[sec_num, list(perf_tuple)] for sec_num, perf_tuple in perf_data]
+    report["output"] = output
+    corpus_state["num_checks"] += 1
+    return report
+
+
+# Returns the HTTP status and JSON response for a request
+async def respond(method:str, path:str, body:bytes) -> (int, dict):
+    loop = asyncio.get_running_loop()
+    if method == "GET" and path == "/status":
+        return 200, {"corpus": corpus_state["signatures"], "loaded_at": corpus_state["loaded_at"],
+                     "num_checks": corpus_state["num_checks"]}
+    if method != "POST" or path != "/check":
+        return 404, {"error": "use POST /check or GET /status"}
+
+    try:
+        request = json.loads(body.decode("utf-8"))
+    except ValueError:
+        return 400, {"error": "the body must be JSON"}
+    if not isinstance(request, dict):
+        return 400, {"error": "the body must be a JSON object"}
+    header, lines = request.get("header"), request.get("lines", [])
+    if not isinstance(header, str) or not isinstance(lines, list) or \
+            not all(isinstance(l, str) for l in lines):
+        return 400, {"error": "give \"header\" as a string and \"lines\" as a list of strings"}
+    if not codecheck.section_start_re.match(header):
+        return 400, {"error": "the header must start a section, e.g., \"§ 61. Gross income defined\""}
+    try:
+        codecheck.parse_header([utils.standardize(header)])
+    except ValueError:
+        return 400, {"error": "the header must give a section number and title, e.g., \"§ 61. Gross income defined\""}
+    start = time.perf_counter()
+    try:
+        report = await loop.run_in_executor(corpus_executor, check_section, header, lines)
+    except Exception as e:
+        print("Check of", repr(header), "failed:", repr(e), file=sys.stderr)
+        return 500, {"error": "the check failed: " + repr(e)}
+    report["seconds"] = time.perf_counter() - start
+    return 200, report
+
+
+# Serves the HTTP/1.1 requests on one connection, keeping it open between
+# requests unless the client asks to close it
+async def handle_connection(reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if request_line == b"":
+                break # the client closed the connection
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in [b"\r\n", b"\n", b""]:
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            try:
+                method, path, version = request_line.decode("latin-1").split()
+                length = int(headers.get("content-length", "0"))
+                if length < 0:
+                    raise ValueError("negative Content-Length")
+            except ValueError:
+                status, response = 400, {"error": "malformed request"}
+                keep_alive = False
+            else:
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                if length > MAX_BODY_BYTES:
+                    status, response = 413, {"error": "request too large"}
+                    keep_alive = False
+                else:
+                    status, response = await respond(method, path, await reader.readexactly(length))
+
+            payload = json.dumps(response).encode("utf-8")
+            writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n"
+                          "Content-Length: %d\r\nConnection: %s\r\n\r\n" %
+                          (status, HTTP_REASONS[status], len(payload), "keep-alive" if keep_alive else "close"))
+                         .encode("latin-1") + payload)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass # the client went away mid-request
+    finally:
+        writer.close()
+
+
+# Polls the corpus files every poll_seconds, reloading the corpus in the
+# background whenever any of them has changed.  If reloading fails, the
+# loaded corpus stays in use, and reloading is tried again once the files
+# change again.
+async def watch_corpus(poll_seconds:float):
+    failed_signatures = None
+    while True:
+        await asyncio.sleep(poll_seconds)
+        try:
+            signatures = corpus_signatures()
+        except OSError:
+            continue # e.g., in the middle of being replaced; try again next time
+        if signatures == corpus_state["signatures"] or signatures == failed_signatures:
+            continue
+        print("Corpus changed on disk; reloading", file=sys.stderr)
+        try:
+            await load_corpus()
+        except Exception as e:
+            failed_signatures = signatures
+            print("Reloading failed; still using the corpus loaded before:", repr(e), file=sys.stderr)
+        else:
+            print("Reloaded corpus", file=sys.stderr)
+
+
+async def serve(args):
+    print("Loading corpus", file=sys.stderr)
+    await load_corpus()
+    if args.unix_socket is not None:
+        server = await asyncio.start_unix_server(handle_connection, path=args.unix_socket)
+        print("Serving on", args.unix_socket, file=sys.stderr)
+    else:
+        server = await asyncio.start_server(handle_connection, args.host, args.port)
+        print("Serving on http://%s:%d" % (args.host, args.port), file=sys.stderr)
+    watcher = asyncio.create_task(watch_corpus(args.poll))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        watcher.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serves checks of single sections against a corpus "
+                                                 "kept in memory.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8026, help="port to listen on (default: %(default)s)")
+    parser.add_argument("--unix-socket", help="listen on this Unix socket instead of a port")
+    parser.add_argument("--poll", type=float, default=5.0,
+                        help="seconds between checks of whether the XML changed on disk (default: %(default)s)")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
@@ -2,9 +2,15 @@
 # Code & Regs file that I made for my class matches up with
 # the information in the official XML versions of the IRC and Treas Regs.
 
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import sys
 import xml.etree.ElementTree as ET
 import re
-import irc, treasregs, utils
+import irc, treasregs, resultstore, utils
 
 special_treatment_starts = ["Chapter",
                             "Unit",
@@ -20,44 +26,275 @@ special_treatment_starts = ["Chapter",
                             "Delaware General Corporation Law",
                             "Prop. Reg."]  # alas, proposed regs aren't in the XML version of the CFR
 
+# Precompiled matchers for the start of a special-treatment section, and of any section
+special_treatment_re = re.compile("|".join(re.escape(s) for s in special_treatment_starts))
+section_start_re = re.compile("|".join(re.escape(s) for s in ["§"] + special_treatment_starts))
 
-# This manages the work of verifying that the title and text matches
-def check_lines(in_lines:list, perf_data:list):
-    lines = []
-    for l in in_lines:
-        lines.append(utils.standardize(l))
 
+# Returns the section number and title text from a section's first line,
+# and whether it is a special-treatment section, Treas Reg, or IRC section
+def parse_header(lines:list) -> (str, str, str):
     sec_num, supp_title_text = lines[0][1:].split(maxsplit=1)
     if sec_num[-1] == ".":
         sec_num = sec_num[:-1] # remove the period if present
 
-    if True in [lines[0].startswith(s) for s in special_treatment_starts]:
-        print("---- Special treatment:", lines[0])
+    if special_treatment_re.match(lines[0]):
+        return sec_num, supp_title_text, "special"
     elif "-" in sec_num:
-        perf_tuple = treasregs.check_TreasReg(sec_num, supp_title_text, lines)
+        return sec_num, supp_title_text, "treasreg"
+    else:
+        return sec_num, supp_title_text, "irc"
+
+
+# This manages the work of verifying that the title and text matches.  If
+# report is given, the kind of section and (unless it is special) its number
+# and what check_IRC or check_TreasReg reports are put in it.
+def check_lines(in_lines:list, perf_data:list, report:dict = None):
+    if report is None:
+        report = {}
+    lines = []
+    for l in in_lines:
+        lines.append(utils.standardize(l))
+
+    sec_num, supp_title_text, kind = parse_header(lines)
+    report["kind"] = kind
+    if kind == "special":
+        print("---- Special treatment:", lines[0])
+        report["verdict"] = "special"
+    elif kind == "treasreg":
+        report["sec_num"] = sec_num
+        perf_tuple = treasregs.check_TreasReg(sec_num, supp_title_text, lines, report)
         perf_data.append((sec_num, perf_tuple))
     else:
-        perf_tuple = irc.check_IRC(sec_num, supp_title_text, lines)
+        report["sec_num"] = sec_num
+        perf_tuple = irc.check_IRC(sec_num, supp_title_text, lines, report)
         perf_data.append((sec_num, perf_tuple))
 
 
-f = open("Code & Regs.txt", "r") # Load the file
+# Runs check_lines in a worker process, returning everything it printed
+# along with its perf_data entries and its report, so the parent can emit
+# them in order
+def check_lines_captured(in_lines:list, report:dict = None) -> (str, list, dict):
+    if report is None:
+        report = {}
+    perf_data = []
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        check_lines(in_lines, perf_data, report)
+    return output.getvalue(), perf_data, report
+
+
+# Loads the corpus before any worker processes are started, so that forked
+# workers share it copy-on-write (and workers that are not forked find the
+# on-disk cache already built).  The supplement is streamed, so which parts
+# it needs is not known in advance; the Treas Reg volumes themselves are left
+# to load lazily from the cache.
+def preload_corpus():
+    irc.load_IRC()
+    treasregs.preload_TR([])
+
+
+# Streams the supplement from f (a file or stdin), yielding each section as
+# its header line and a list of its other lines as soon as the next header
+# (or the end) is read
+def iter_sections(f):
+    header = None # Don't store anything until we find a section
+    lines = []
+    for l in f:
+        if section_start_re.match(l):  # Found a start of a section
+            if header is not None:
+                yield header, lines # prior section is complete
+            header, lines = l, [] # reset and start gathering
+        elif header is not None:
+            lines.append(l)
+    if header is not None:
+        yield header, lines # the final section
+
+
+# Returns the result store key for checking a section, or None if its
+# result should not be stored (special-treatment sections and sections
+# missing from the XML)
+def section_key(in_lines:list) -> str:
+    lines = []
+    for l in in_lines:
+        lines.append(utils.standardize(l))
+    sec_num, supp_title_text, kind = parse_header(lines)
+    if kind == "special":
+        return None
+    return resultstore.section_key(kind, sec_num, supp_title_text, lines)
+
+
+# Whether a check's report shows a problem with the section: one that did
+# not match, was not found, or has a heading that does not match
+def has_problem(report:dict) -> bool:
+    return report.get("verdict") in ["failure", "not found"] or "heading_mismatch" in report
 
-perf_data = []
-current_in_lines = None # Don't store anything until we find a section
-for idx_l, l in enumerate(f.readlines()):
 
-    if l[0] == "§" or True in [l.startswith(s) for s in special_treatment_starts]:  # Found a start of a section
-        if current_in_lines is not None:
-            check_lines(current_in_lines, perf_data) # process prior section
-        current_in_lines = [l] # reset and start gathering
-    elif current_in_lines is not None:
-        current_in_lines.append(l)
-check_lines(current_in_lines, perf_data) # handle the final section
+# Returns (key, printed output, perf_data entries, whether the section has a
+# problem, whether the match was budget-limited) for a task from check_tasks,
+# checking the section only if there is no stored result
+def run_check_task(task:tuple) -> (str, str, list, bool, bool):
+    in_lines, key, stored = task
+    if stored is not None:
+        return (key,) + stored + (False,) # budget-limited results are never stored
+    output, perf_data, report = check_lines_captured(in_lines)
+    return key, output, perf_data, has_problem(report), report.get("budget_limited", False)
 
-for sec_num, perf_tuple in perf_data:
-    print("{:10s} {:7.3f} {:6d} {:6d} {:6d} {:6d} {:6d} {:6d}".format(sec_num,
-                                                                (perf_tuple[3]/float(perf_tuple[0]+0.0001)), \
-                                                            perf_tuple[0], \
-                                                           perf_tuple[1], perf_tuple[2],
-                                                           perf_tuple[3], perf_tuple[4], perf_tuple[5]))
\ No newline at end of file
+
+# Yields a task for each section: its lines, its store key, and its stored
+# result, if any
+def check_tasks(sections, store:resultstore.ResultStore):
+    for header, lines in sections:
+        in_lines = [header] + lines
+        key = section_key(in_lines) if store is not None else None
+        stored = store.get(key) if store is not None and key in store else None
+        yield in_lines, key, stored
+
+
+# Sets the budget for matching any one section, e.g., in a worker process
+# as it was set in the parent
+def set_match_budget(time_budget:float, memo_budget:int):
+    utils.MATCH_TIME_BUDGET, utils.MATCH_MEMO_BUDGET = time_budget, memo_budget
+
+
+# Starts the pool of worker processes for checking sections, or returns None
+# if there is to be only one process
+def start_pool(jobs:int):
+    if jobs <= 1:
+        return None
+    preload_corpus()
+    start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+    return multiprocessing.get_context(start_method).Pool(jobs, initializer=set_match_budget,
+                                                          initargs=(utils.MATCH_TIME_BUDGET, utils.MATCH_MEMO_BUDGET))
+
+
+# Yields (key, printed output, perf_data entries, whether the section has a
+# problem) for each section, in order,
+# checking them in the pool if there is one.  With a store, sections whose
+# result is already in it are reported from it without being checked again,
+# and new results are added, except budget-limited ones: whether a section
+# goes over budget depends on how loaded the machine is, so such a result
+# may well be different next time.
+def check_results(sections, pool, store:resultstore.ResultStore = None):
+    if pool is None:
+        results = map(run_check_task, check_tasks(sections, store))
+    else:
+        # imap hands back results in supplement order, whatever order they finish in
+        results = pool.imap(run_check_task, check_tasks(sections, store))
+    for key, output, section_perf_data, problem, budget_limited in results:
+        if store is not None and not budget_limited:
+            store.put(key, output, section_perf_data, problem)
+        yield key, output, section_perf_data, problem
+
+
+# Checks every section as it is read, printing the results in supplement
+# order, and returns the perf_data
+def check_sections(sections, pool, store:resultstore.ResultStore = None) -> list:
+    perf_data = []
+    for _, output, section_perf_data, _ in check_results(sections, pool, store):
+        print(output, end="", flush=True)
+        perf_data.extend(section_perf_data)
+    return perf_data
+
+
+# Returns the supplement files to check: the paths given, with each
+# directory replaced by the .txt files in it
+def supplement_paths(paths:list) -> list:
+    rv = []
+    for path in paths:
+        if os.path.isdir(path):
+            rv.extend(sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".txt")))
+        else:
+            rv.append(path)
+    return rv
+
+
+# Returns the sections of the supplement at path (- for stdin)
+def read_supplement(path:str) -> list:
+    if path == "-":
+        return list(iter_sections(sys.stdin))
+    with open(path, "r") as f:
+        return list(iter_sections(f))
+
+
+# Checks several supplements at once, printing a report for each.  A section
+# that appears (after standardizing) in more than one supplement is only
+# checked once, so the time grows with the number of distinct sections.
+def check_supplements(paths:list, pool, store:resultstore.ResultStore = None):
+    supplements = []
+    unique_sections = {} # standardized lines -> (header, lines), in first-seen order
+    for path in paths:
+        keys = []
+        for header, lines in read_supplement(path):
+            key = tuple(utils.standardize(l) for l in [header] + lines)
+            unique_sections.setdefault(key, (header, lines))
+            keys.append(key)
+        supplements.append((path, keys))
+
+    results = {}
+    for key, (_, output, section_perf_data, problem) in zip(unique_sections,
+                                                            check_results(unique_sections.values(), pool, store)):
+        results[key] = (output, section_perf_data, problem)
+    print("Checked", len(unique_sections), "distinct sections from", len(paths), "supplements")
+
+    for path, keys in supplements:
+        print("===================================\nSupplement:", path)
+        perf_data = []
+        num_failed = 0
+        for key in keys:
+            output, section_perf_data, problem = results[key]
+            print(output, end="")
+            perf_data.extend(section_perf_data)
+            if problem:
+                num_failed += 1
+        print("Sections =", len(keys), "  with problems =", num_failed)
+        print_perf_data(perf_data)
+
+
+def print_perf_data(perf_data:list):
+    for sec_num, perf_tuple in perf_data:
+        print("{:10s} {:7.3f} {:6d} {:6d} {:6d} {:6d} {:6d} {:6d}".format(sec_num,
+                                                                    (perf_tuple[3]/float(perf_tuple[0]+0.0001)), \
+                                                                perf_tuple[0], \
+                                                               perf_tuple[1], perf_tuple[2],
+                                                               perf_tuple[3], perf_tuple[4], perf_tuple[5]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Checks a statutory supplement against "
+                                                 "the official XML of the IRC and Treas Regs.")
+    parser.add_argument("supplements", nargs="*", default=["Code & Regs.txt"],
+                        help="the supplements to check, or directories of them, "
+                             "or - for stdin (default: Code & Regs.txt)")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of worker processes to check sections with (default: 1)")
+    parser.add_argument("--results", default=resultstore.RESULTS_PATH,
+                        help="file storing earlier results, so that only changed sections "
+                             "are re-checked (default: %(default)s)")
+    parser.add_argument("--recheck-all", action="store_true",
+                        help="re-check every section, ignoring (but keeping) stored results")
+    parser.add_argument("--match-seconds", type=float, default=utils.MATCH_TIME_BUDGET,
+                        help="seconds that matching any one section may take before it is matched "
+                             "only approximately and marked BUDGET-LIMITED; 0 for no limit (default: %(default)s)")
+    parser.add_argument("--match-memo", type=int, default=utils.MATCH_MEMO_BUDGET,
+                        help="the same, as a number of (supplement, XML) index pairs tried; "
+                             "0 for no limit (default: %(default)s)")
+    args = parser.parse_args()
+
+    set_match_budget(args.match_seconds or None, args.match_memo or None)
+    store = resultstore.ResultStore(args.results, reuse=not args.recheck_all)
+    paths = supplement_paths(args.supplements)
+    pool = start_pool(args.jobs)
+    if len(paths) == 1:
+        if paths[0] == "-":
+            perf_data = check_sections(iter_sections(sys.stdin), pool, store)
+        else:
+            with open(paths[0], "r") as f: # Load the file
+                perf_data = check_sections(iter_sections(f), pool, store)
+        print_perf_data(perf_data)
+    else:
+        check_supplements(paths, pool, store)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    store.save()
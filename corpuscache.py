@@ -0,0 +1,253 @@
+# On-disk cache of the sections parsed out of the official XML (usc26.xml and
+# the CFR-title-26 volumes), so that later runs can skip XML parsing entirely.
+#
+# Each source file gets its own pair of cache files in CACHE_DIR:
+#   <name>.json      header: source path, size, mtime, SHA-256 of the source,
+#                    and each section's key, status and number
+#   <name>.<sha>.dat the sections' texts and then their headings, standardized
+#                    and in UTF-8, back to back in one buffer, followed by
+#                    arrays of 64-bit integers giving, for each section, where
+#                    its text and heading start in the buffer, where the list
+#                    of their words' starts begins, and its flags; and then
+#                    that list of the start of every word in the buffer
+# The data file is memory-mapped, and the arrays are used in place, so whole
+# corpus statistics like word counts need no text to be decoded at all, and
+# each section's text is only decoded when it is asked for.  A changed source
+# file only rebuilds its own pair.
+
+import array
+import hashlib
+import json
+import mmap
+import os
+import re
+
+import utils
+
+CACHE_DIR = "corpus_cache"
+CACHE_FORMAT = 3
+
+# The flags kept for each section
+HAS_KEY = 1
+HAS_HEADING = 2
+RESERVED = 4 # a status of "reserved"
+REPEALED = 8 # a status of "repealed"
+
+word_re = re.compile(rb"[^ ]+") # standardized text has no whitespace but single spaces
+
+
+def file_digest(path:str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Returns the name in CACHE_DIR for files about the given source file or
+# directory: its base name, to be readable, and a hash of its absolute path,
+# so that same-named sources in different places do not collide
+def _cache_name(source_path:str) -> str:
+    source_path = os.path.normpath(source_path)
+    path_hash = hashlib.sha1(os.path.abspath(source_path).encode()).hexdigest()[:12]
+    return os.path.join(CACHE_DIR, os.path.basename(source_path) + "." + path_hash)
+
+
+def _header_path(source_path:str) -> str:
+    return _cache_name(source_path) + ".json"
+
+
+def _manifest_path(source_dir:str) -> str:
+    return _cache_name(source_dir) + ".manifest.json"
+
+
+# The cached sections of one source file.  Iterating yields
+# (key, heading, text, status) tuples in document order, where the text is
+# standardized and the heading is as the checkers compare it (standardized,
+# without trailing periods), or None if the section has no heading.
+class CachedCorpus:
+    def __init__(self, header:dict, data_path:str):
+        self.source = header["source"]
+        self.keys = header["keys"]
+        self.statuses = header["statuses"]
+        self.nums = header["nums"] # each section's number as given in the XML, or None
+        n = len(self.keys)
+        with open(data_path, "rb") as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        arrays = memoryview(self._buffer)[header["arrays_offset"]:].cast("q")
+        self.text_bounds = arrays[0:n+1] # section idx's text is buffer[text_bounds[idx]:text_bounds[idx+1]]
+        self.heading_bounds = arrays[n+1:2*n+2]
+        self.text_words = arrays[2*n+2:3*n+3] # its words start at word_starts[text_words[idx]:text_words[idx+1]]
+        self.heading_words = arrays[3*n+3:4*n+4]
+        self.flags = arrays[4*n+4:5*n+4]
+        self.word_starts = arrays[5*n+4:]
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def text(self, idx:int) -> str:
+        return self._buffer[self.text_bounds[idx]:self.text_bounds[idx+1]].decode("utf-8")
+
+    def heading(self, idx:int) -> str:
+        if not self.flags[idx] & HAS_HEADING:
+            return None
+        return self._buffer[self.heading_bounds[idx]:self.heading_bounds[idx+1]].decode("utf-8")
+
+    def num_words(self, idx:int) -> int:
+        return self.text_words[idx+1] - self.text_words[idx]
+
+    def num_heading_words(self, idx:int) -> int:
+        return self.heading_words[idx+1] - self.heading_words[idx]
+
+    # Returns the number of sections having all the flags in require and none
+    # of those in exclude, and the number of words in their texts and headings
+    def totals(self, require:int = 0, exclude:int = 0) -> (int, int, int):
+        n = len(self.keys)
+        if require == 0 and exclude == 0:
+            return n, self.text_words[n] - self.text_words[0], self.heading_words[n] - self.heading_words[0]
+        selected = [idx for idx, flags in enumerate(self.flags)
+                    if flags & require == require and not flags & exclude]
+        return len(selected), sum(self.num_words(idx) for idx in selected), \
+               sum(self.num_heading_words(idx) for idx in selected)
+
+    def record(self, idx:int) -> tuple:
+        return self.keys[idx], self.heading(idx), self.text(idx), self.statuses[idx]
+
+    def __iter__(self):
+        for idx in range(len(self.keys)):
+            yield self.record(idx)
+
+
+def _read_header(header_path:str):
+    try:
+        with open(header_path, "r", encoding="utf-8") as f:
+            header = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if header.get("format") != CACHE_FORMAT:
+        return None
+    return header
+
+
+def _write_atomically(path:str, data:bytes):
+    tmp_path = path + ".tmp" + str(os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+# Appends the start of each word of the encoded standardized text, which is
+# at offset in the buffer, to word_starts
+def _add_word_starts(word_starts:array.array, encoded:bytes, offset:int):
+    word_starts.extend(offset + m.start() for m in word_re.finditer(encoded))
+
+
+def _build(source_path:str, build_records, header_path:str) -> dict:
+    st = os.stat(source_path)
+    digest = file_digest(source_path)
+    data_path = header_path[:-len(".json")] + "." + digest[:16] + ".dat"
+
+    keys, statuses, nums, headings = [], [], [], []
+    text_bounds, text_words = array.array("q", [0]), array.array("q", [0])
+    flags, word_starts = array.array("q"), array.array("q")
+    offset = 0
+    tmp_path = data_path + ".tmp" + str(os.getpid())
+    with open(tmp_path, "wb") as f: # the texts are written as the records stream in
+        for key, heading, text, status, num in build_records(source_path):
+            encoded = utils.standardize(text).encode("utf-8")
+            _add_word_starts(word_starts, encoded, offset)
+            f.write(encoded)
+            offset += len(encoded)
+            text_bounds.append(offset)
+            text_words.append(len(word_starts))
+            keys.append(key)
+            statuses.append(status)
+            nums.append(num)
+            headings.append(None if heading is None else utils.standardize(heading).strip("."))
+            flags.append((HAS_KEY if key is not None else 0) | (HAS_HEADING if heading is not None else 0) |
+                         (RESERVED if status == "reserved" else 0) | (REPEALED if status == "repealed" else 0))
+
+        heading_bounds, heading_words = array.array("q", [offset]), array.array("q", [len(word_starts)])
+        for heading in headings:
+            encoded = (heading or "").encode("utf-8")
+            _add_word_starts(word_starts, encoded, offset)
+            f.write(encoded)
+            offset += len(encoded)
+            heading_bounds.append(offset)
+            heading_words.append(len(word_starts))
+
+        arrays_offset = offset + (-offset % 8) # aligned for the 64-bit arrays
+        f.write(b"\0" * (arrays_offset - offset))
+        for a in [text_bounds, heading_bounds, text_words, heading_words, flags, word_starts]:
+            a.tofile(f)
+    os.replace(tmp_path, data_path)
+
+    header = {"format": CACHE_FORMAT,
+              "source": source_path,
+              "size": st.st_size,
+              "mtime": st.st_mtime_ns,
+              "sha256": digest,
+              "data_file": os.path.basename(data_path),
+              "arrays_offset": arrays_offset,
+              "keys": keys,
+              "statuses": statuses,
+              "nums": nums}
+    old_header = _read_header(header_path)
+    _write_atomically(header_path, json.dumps(header).encode("utf-8"))
+    if old_header is not None and old_header["data_file"] != header["data_file"]:
+        try:
+            os.remove(os.path.join(CACHE_DIR, old_header["data_file"]))
+        except OSError:
+            pass
+    return header
+
+
+# The size and mtime of a source file, as recorded in the cache headers
+def source_signature(path:str) -> list:
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+# A manifest is a small JSON file in CACHE_DIR in which a caller can record,
+# for each source file in a directory, its signature plus a summary such as
+# which sections it contains, so that it can pick which sources to load
+# without opening them.
+def read_manifest(source_dir:str) -> dict:
+    try:
+        with open(_manifest_path(source_dir), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("format") != CACHE_FORMAT:
+        return {}
+    return manifest["sources"]
+
+
+def write_manifest(source_dir:str, sources:dict):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    _write_atomically(_manifest_path(source_dir),
+                      json.dumps({"format": CACHE_FORMAT, "sources": sources}).encode("utf-8"))
+
+
+# Returns the cached sections of source_path, first (re)building the cache
+# with build_records(source_path) if the source has changed.
+# build_records must yield (key, heading, text, status, num) tuples, with the
+# text and heading as flattened from the XML and num the section's number.
+def load(source_path:str, build_records) -> CachedCorpus:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    header_path = _header_path(source_path)
+    header = _read_header(header_path)
+    st = os.stat(source_path)
+    if header is not None and \
+            (header["size"], header["mtime"]) != (st.st_size, st.st_mtime_ns):
+        # Touched, but perhaps not changed; only the content hash can tell
+        if header["size"] == st.st_size and header["sha256"] == file_digest(source_path):
+            header["mtime"] = st.st_mtime_ns
+            _write_atomically(header_path, json.dumps(header).encode("utf-8"))
+        else:
+            header = None
+    if header is not None and not os.path.exists(os.path.join(CACHE_DIR, header["data_file"])):
+        header = None
+    if header is None:
+        header = _build(source_path, build_records, header_path)
+    return CachedCorpus(header, os.path.join(CACHE_DIR, header["data_file"]))
@@ -4,81 +4,156 @@
 import xml.etree.ElementTree as ET
 import re
 
+import corpuscache
 import utils
 
 usc_ns_str = "http://xml.house.gov/schemas/uslm/1.0"
 
 ns = {"usc" : usc_ns_str}
 
+# Gets all non-header text from NON-repealed sections.  Walks the tree with an
+# explicit stack, collecting the pieces of text to join once at the end, so
+# that the time is linear in the size of the section and deep nesting cannot
+# hit Python's recursion limit.
+def get_IRC_text_recursive(x:ET.Element, top_level = True) -> str:
+    pieces = []
+    # each entry is either an (element, top_level) to visit or a tail to emit
+    # once all of the element's children have been emitted
+    stack = [(x, top_level)]
+    while len(stack) > 0:
+        entry = stack.pop()
+        if isinstance(entry, str):
+            pieces.append(entry)
+            continue
+        x, top_level = entry
+        if x.text is not None:
+            pieces.append(x.text)
+            pieces.append(" ")
+        if x.tail is not None:
+            stack.append(" ")
+            stack.append(x.tail)
+        subs = []
+        for sub in x:
+            if "status" not in sub.attrib:
+                if "sourceCredit" not in sub.tag and \
+                        "notes" not in sub.tag and \
+                        (not top_level or ("num" not in sub.tag and "heading" not in sub.tag)):
+                    subs.append((sub, False))
+            else:
+                # Count of statuses in all of IRC was the following: {'': 519201, 'repealed': 32}
+                # Thus we are making the assumption asserted below
+                assert sub.attrib["status"] == "repealed"
+        stack.extend(reversed(subs))
+    return "".join(pieces)
+
+
+# Yields (identifier, heading text, flattened text, status, num value) for
+# every section element in the XML, in document order, with None for a missing
+# identifier, heading or num.  Streams the file, so the whole tree is never
+# held in memory.
+def IRC_records_from_xml(path:str):
+    section_tag = '{' + usc_ns_str + '}section'
+    for outermost in utils.iterparse_outermost(path, section_tag):
+        for s in outermost.iter(section_tag):
+            heading = s.find('usc:heading', ns)
+            num = s.find('usc:num', ns)
+            yield s.attrib.get("identifier"), \
+                  heading.text if heading is not None else None, \
+                  get_IRC_text_recursive(s), \
+                  s.attrib.get("status", ""), \
+                  num.attrib.get("value") if num is not None else None
+
 
-# Load the IRC itself
 # usc26.xml was downloaded from https://uscode.house.gov/download/download.shtml
-irc_tree = ET.parse("usc26.xml")
-irc_root = irc_tree.getroot()
+IRC_XML_PATH = "usc26.xml"
+
+# The IRC itself, and an index from lowercased identifier (e.g., "/us/usc/t26/s61")
+# to the list of positions in irc_corpus of every section with that identifier,
+# so that each lookup is one dictionary probe.  Nothing is loaded until
+# load_IRC is first called, and a section's text is only read when looked up.
+irc_corpus = None
+irc_index = None
+
+# Returns the IRC and its index, read from the on-disk cache unless
+# IRC_XML_PATH has changed, without touching the loaded IRC
+def read_IRC() -> (corpuscache.CachedCorpus, dict):
+    corpus = corpuscache.load(IRC_XML_PATH, IRC_records_from_xml)
+    index = {}
+    for idx, identifier in enumerate(corpus.keys):
+        if identifier is not None:
+            index.setdefault(identifier.lower(), []).append(idx)
+    return corpus, index
+
+
+# Loads the IRC, from the on-disk cache unless IRC_XML_PATH has changed
+def load_IRC():
+    global irc_corpus, irc_index
+    if irc_corpus is None:
+        irc_corpus, irc_index = read_IRC()
+    return irc_corpus
+
+
+# Forgets the loaded IRC, so that the next lookup loads it again, e.g., after
+# IRC_XML_PATH has changed on disk
+def unload_IRC():
+    global irc_corpus, irc_index
+    irc_corpus, irc_index = None, None
+
+
+# Returns the section's standardized heading and text from the XML, as
+# cached, or None if there is no such section
+def lookup_IRC(sec_num:str) -> (str, str):
+    load_IRC()
+    matches = irc_index.get("/us/usc/t26/s" + sec_num.lower(), [])
+    assert len(matches) <= 1, "Should be only one match"
+    if len(matches) == 0:
+        return None
+    assert irc_corpus.nums[matches[0]].lower() == sec_num.lower()
+    # print("Raw XML:", ET.tostring(irc_sec)) # useful for debug
+    return irc_corpus.heading(matches[0]), irc_corpus.text(matches[0])
 
-# Gets all non-header text from NON-repealed sections
-def get_IRC_text_recursive(x:ET.Element, top_level = True) -> str:
-    rv = ""
-    if x.text is not None:
-        rv += x.text + " "
-    for sub in x:
-        if "status" not in sub.attrib:
-            if "sourceCredit" not in sub.tag and \
-                    "notes" not in sub.tag and \
-                    (not top_level or ("num" not in sub.tag and "heading" not in sub.tag)):
-                rv += get_IRC_text_recursive(sub, False)
-        else:
-            # Count of statuses in all of IRC was the following: {'': 519201, 'repealed': 32}
-            # Thus we are making the assumption asserted below
-            assert sub.attrib["status"] == "repealed"
-    if x.tail is not None:
-        rv += x.tail + " "
-    return rv
-
-
-
-
-def check_IRC(sec_num:str, supp_title_text:str, in_lines:list):
+
+# If report is given, the verdict ("success", "failure", or "not found"), any
+# heading mismatch, and where any failure is are also put in it
+def check_IRC(sec_num:str, supp_title_text:str, in_lines:list, report:dict = None):
+    if report is None:
+        report = {}
     # if sec_num == "67": # for debug
     #     print("here")
 
     print("-----------------------------------\nSection:", sec_num)
-    irc_sec = None
-    for s in irc_root.iter('{' + usc_ns_str + '}section'):
-        if "identifier" in s.attrib and \
-                s.attrib["identifier"].lower() == "/us/usc/t26/s" + sec_num.lower():
-            assert irc_sec is None, "Should be only one match"
-            irc_sec = s
-            assert s.find("usc:num", ns).attrib["value"].lower() == sec_num.lower()
-
-    if irc_sec is None:
+    xml_texts = lookup_IRC(sec_num)
+    if xml_texts is None:
         print("FAILED TO FIND SECTION:  ", sec_num, "   CANCELLING")
+        report["verdict"] = "not found"
+        return (0,0,0,0,0,0)
+    xml_heading_text, xml_str = xml_texts
 
     # Check the title
-    xml_heading_text = utils.standardize(irc_sec.find('usc:heading', ns).text.strip()).strip(".")
     supp_title_text = supp_title_text.strip().strip(".")
     if xml_heading_text != supp_title_text:
         print("FAILED TO MATCH HEADER ", sec_num)
         print(xml_heading_text)
         print(supp_title_text)
-
-    # gather the XML text
-    xml_str = utils.standardize(get_IRC_text_recursive(irc_sec))
-    # print("Raw XML:", ET.tostring(irc_sec)) # useful for debug
-    xml_str = " ".join(xml_str.split()) # normalize whitespace
+        report["heading_mismatch"] = {"xml": xml_heading_text, "supp": supp_title_text}
 
     supp_str = utils.process_supp_lines(in_lines, sec_num)
 
     dual_indexes_tried = {}
     fail_start_idx_ellipsis = {}
-    result, num_recursive_calls = \
-        utils.recursive_match(supp_str, 0, xml_str, 0, dual_indexes_tried, fail_start_idx_ellipsis) # actual function call
+    result, num_recursive_calls, furthest, budget_limited = \
+        utils.budgeted_match(supp_str, xml_str, dual_indexes_tried, fail_start_idx_ellipsis) # actual function call
+    if budget_limited:
+        print("BUDGET-LIMITED: matching went over budget, so the result below is only approximate")
+        report["budget_limited"] = True
     if not result:
-        print("IRC FAILURE", sec_num)
-        utils.find_error(supp_str, xml_str)
+        print("IRC FAILURE", sec_num + (" (BUDGET-LIMITED)" if budget_limited else ""))
+        report["verdict"] = "failure"
+        report["failure"] = utils.find_error(supp_str, xml_str, furthest)
         print("XML string:", xml_str)
     else:
-        print("IRC SUCCESS", sec_num)
+        print("IRC SUCCESS", sec_num + (" (BUDGET-LIMITED)" if budget_limited else ""))
+        report["verdict"] = "success"
 
     return len(xml_str), len(supp_str), \
            num_recursive_calls, len(dual_indexes_tried), \
@@ -87,49 +162,38 @@ def check_IRC(sec_num:str, supp_title_text:str, in_lines:list):
 
 if __name__ == '__main__':
     print("Counting number of words and sections in IRC")
-    section_count = 0 # only counts non-reserved sections
-    sections_without_heading = 0
-    sections_without_identifier = 0
-    word_count = 0
-    word_count_sections_without_heading = 0
-    word_count_sections_without_identifier = 0
+    corpus = load_IRC()
     last_named_section = "None"
-    for s in irc_root.iter('{' + usc_ns_str + '}section'):
-        section_count += 1
-        section_text = utils.standardize(get_IRC_text_recursive(s))
-        word_count += len(section_text.split())
-
+    for idx, identifier in enumerate(corpus.keys):
         # The code below is used to print out a single section's text and stats.
         # If you paste the printed text into a Microsoft Word document, you see
         # that the word counts match.
-        if "identifier" in s.attrib and \
-                s.attrib["identifier"].lower() == "/us/usc/t26/s61":
+        if identifier is not None and identifier.lower() == "/us/usc/t26/s61":
             print("***********************************")
-            print(section_text)
-            print("Got total", len(section_text.split()))
+            print(corpus.text(idx))
+            print("Got total", corpus.num_words(idx))
             print("***********************************")
 
-        if s.find('usc:heading', ns) is None:
+        if not corpus.flags[idx] & corpuscache.HAS_HEADING:
             # There are some weird sections that seem to be statutes passed by Congress relating
             # to the IRC that appear in the XML as sections, but are not actual sections.  They
             # seem like they should have been put as notes at the end of sections, but were not.
-            sections_without_heading += 1
-            word_count_sections_without_heading += len(section_text.split())
             print("After", last_named_section, ", a no-heading section")
+        elif identifier is None:
+            print("After", last_named_section, ", a no-identifier section")
         else: # these are the normal sections
-            title_text = utils.standardize(s.find('usc:heading', ns).text.strip()).strip(".")
-            word_count += len(title_text.split())
-            if "identifier" not in s.attrib:
-                sections_without_identifier += 1
-                word_count_sections_without_identifier += len(section_text.split()) + len(title_text.split())
-                print("After", last_named_section, ", a no-identifier section")
-            else:
-                assert s.attrib["identifier"].startswith("/us/usc/t26/")
-                last_named_section = s.attrib["identifier"][len("/us/usc/t26/"):]
+            assert identifier.startswith("/us/usc/t26/")
+            last_named_section = identifier[len("/us/usc/t26/"):]
+
+    section_count, text_words, heading_words = corpus.totals()
+    sections_without_heading, word_count_sections_without_heading, _ = \
+        corpus.totals(exclude=corpuscache.HAS_HEADING)
+    sections_without_identifier, text_words_without_identifier, heading_words_without_identifier = \
+        corpus.totals(require=corpuscache.HAS_HEADING, exclude=corpuscache.HAS_KEY)
 
     print("Total sections =", section_count)
-    print("Total words =", word_count)
+    print("Total words =", text_words + heading_words)
     print("Total sections without heading =", sections_without_heading)
     print("Total words in sections without heading =", word_count_sections_without_heading)
     print("Total sections without identifier =", sections_without_identifier)
-    print("Total words in sections without identifier =", word_count_sections_without_identifier)
+    print("Total words in sections without identifier =", text_words_without_identifier + heading_words_without_identifier)
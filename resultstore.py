@@ -0,0 +1,92 @@
+# Store of earlier check results, so that a run only re-checks the sections
+# of the supplement that were edited, or whose official text changed, since
+# the run that stored them.  Each result is keyed by a hash of everything the
+# check depends on: the section number, the supplement's processed title and
+# text, the XML's heading and text, and the source of the checking code itself.
+
+import hashlib
+import json
+import os
+import time
+
+import irc, treasregs, utils
+
+RESULTS_PATH = "check_results.json"
+
+# The most results kept; beyond that, those least recently used are dropped
+MAX_RESULTS = 20000
+
+# The source files whose code decides what a check prints, all found next to
+# this one (codecheck.py is read rather than imported, as it imports this)
+CHECKER_SOURCES = ["codecheck.py", "utils.py", "irc.py", "treasregs.py"]
+
+
+# The checking code.  (The match budget is left out: budget-limited results
+# are never stored, so every stored result is exact whatever the budget.)
+def _checker_digest() -> str:
+    h = hashlib.sha256()
+    for filename in CHECKER_SOURCES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), filename), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+# Returns the key for checking the given section, or None if it is not in
+# the XML (such sections are cheap to re-check, so they are never stored)
+def section_key(kind:str, sec_num:str, supp_title_text:str, lines:list) -> str:
+    if kind == "treasreg":
+        xml_texts = treasregs.lookup_TreasReg(sec_num)
+    else:
+        xml_texts = irc.lookup_IRC(sec_num)
+    if xml_texts is None:
+        return None
+    xml_heading_text, xml_str = xml_texts
+    h = hashlib.sha256()
+    for part in [kind, sec_num, supp_title_text, utils.process_supp_lines(lines, sec_num),
+                 xml_heading_text, hashlib.sha256(xml_str.encode("utf-8")).hexdigest()]:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+# With reuse False, no stored result is used, but the results are still
+# stored, without losing those for other sections
+class ResultStore:
+    def __init__(self, path:str = RESULTS_PATH, reuse:bool = True):
+        self.path = path
+        self.reuse = reuse
+        self.checker = _checker_digest()
+        self.results = {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            if stored.get("checker") == self.checker: # older code may have checked differently
+                self.results = stored["results"]
+        except (OSError, ValueError):
+            pass
+
+    def __contains__(self, key:str) -> bool:
+        return self.reuse and key is not None and key in self.results
+
+    # Returns what the check printed, its perf_data entries, and whether it
+    # found a problem with the section
+    def get(self, key:str) -> (str, list, bool):
+        result = self.results[key]
+        result["used"] = time.time()
+        return result["output"], [(sec_num, tuple(perf_tuple)) for sec_num, perf_tuple in result["perf_data"]], \
+               result["problem"]
+
+    def put(self, key:str, output:str, perf_data:list, problem:bool):
+        if key is not None:
+            self.results[key] = {"output": output, "perf_data": perf_data, "problem": problem,
+                                 "used": time.time()}
+
+    # Saves the results, keeping only the MAX_RESULTS most recently used
+    def save(self):
+        if len(self.results) > MAX_RESULTS:
+            recent = sorted(self.results, key=lambda key: self.results[key].get("used", 0), reverse=True)
+            self.results = {key: self.results[key] for key in recent[:MAX_RESULTS]}
+        tmp_path = self.path + ".tmp" + str(os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"checker": self.checker, "results": self.results}, f)
+        os.replace(tmp_path, self.path)
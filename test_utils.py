@@ -0,0 +1,71 @@
+# Checks ellipsis_match against recursive_match, the exhaustive reference
+# matcher, on random supplement/XML pairs, that ellipsis_match stays fast
+# where a final segment matches a long way at many offsets, and that it
+# locates an error where the original binary search did.
+#
+#   python -m pytest test_utils.py
+
+import random
+
+import utils
+
+ALPHABET = ["a", "b", "c", " ", ".", "(", "-", ","]
+
+
+# Returns a random XML text and a supplement made from it by cutting spans
+# out as ellipses, sometimes with a typo added
+def random_pair(rng:random.Random) -> (str, str):
+    xml_str = " ".join("".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 25))).split())
+    supp_str = xml_str
+    for _ in range(rng.randint(0, 3)):
+        if len(supp_str) > 2:
+            start = rng.randint(0, len(supp_str) - 1)
+            end = rng.randint(start, min(len(supp_str), start + 6))
+            supp_str = supp_str[:start] + rng.choice([" … ", "…", " …", "… "]) + supp_str[end:]
+    if len(supp_str) > 0 and rng.random() < 0.3:
+        idx = rng.randint(0, len(supp_str) - 1)
+        supp_str = supp_str[:idx] + rng.choice(ALPHABET) + supp_str[idx+1:]
+    return " ".join(supp_str.split()), xml_str
+
+
+def test_ellipsis_match_agrees_with_recursive_match():
+    rng = random.Random(26)
+    for _ in range(5000):
+        supp_str, xml_str = random_pair(rng)
+        expected, _ = utils.recursive_match(supp_str, 0, xml_str, 0, {}, {})
+        success, _, _ = utils.ellipsis_match(supp_str, xml_str, {}, {})
+        assert success == expected, (supp_str, xml_str)
+
+
+def test_final_segment_with_long_prefix_at_many_anchors():
+    supp_str = "a … " + "a b " * 500 + "c"
+    success, num_attempts, furthest = utils.ellipsis_match(supp_str, "a b " * 5000 + "d", {}, {})
+    assert not success and num_attempts < 100
+    assert furthest[0] == len(supp_str) - 1 # stopped at the "c"
+    success, num_attempts, _ = utils.ellipsis_match(supp_str, "a b " * 5000 + "c", {}, {})
+    assert success and num_attempts < 10
+
+
+# Returns where the original find_error put a failed match's error: the
+# longest prefix of supp_str that, followed by an ellipsis, still matches,
+# found by binary search
+def binary_search_error(supp_str:str, xml_str:str) -> int:
+    idx_known_good, idx_known_bad = 0, len(supp_str)
+    while idx_known_good < idx_known_bad - 1:
+        idx_to_try = (idx_known_good + idx_known_bad) // 2
+        success, _ = utils.recursive_match(supp_str[:idx_to_try] + "…", 0, xml_str, 0, {}, {})
+        if success:
+            idx_known_good = idx_to_try
+        else:
+            idx_known_bad = idx_to_try
+    return idx_known_good
+
+
+def test_error_in_final_segment_is_the_first_one():
+    rng = random.Random(26)
+    words = " ".join(rng.choice(["alpha", "beta", "gamma", "of", "the"]) for _ in range(200))
+    supp_str = "Intro text … the amount of TAX shall be " + words + " and the END of it."
+    xml_str = "Intro text which is left out. the amount of tax shall be " + words + " and the end of it."
+    success, _, furthest = utils.ellipsis_match(supp_str, xml_str, {}, {})
+    assert not success
+    assert furthest[0] == binary_search_error(supp_str, xml_str) == supp_str.index("TAX")
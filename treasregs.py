@@ -5,112 +5,265 @@ import xml.etree.ElementTree as ET
 import os
 import re
 
+import corpuscache
 import utils
 
 
-# Gets all non-header text from NON-repealed sections
+# Gets all non-header text from NON-repealed sections.  Walks the tree with an
+# explicit stack, collecting the pieces of text to join once at the end, so
+# that the time is linear in the size of the section and deep nesting cannot
+# hit Python's recursion limit.
 def get_TR_text_recursive(x:ET.Element) -> str:
-    if x.tag in ["SECTNO", "SUBJECT", "CITA"]:
-        return ""
+    pieces = []
+    # each entry is either an element to visit or a tail to emit once all of
+    # the element's children have been emitted
+    stack = [x]
+    while len(stack) > 0:
+        x = stack.pop()
+        if isinstance(x, str):
+            pieces.append(x)
+            continue
+        if x.tag in ["SECTNO", "SUBJECT", "CITA"]:
+            continue
 
-    rv = ""
-    if x.text is not None:
-        rv += x.text + " "
-    for sub in x:
-        rv += get_TR_text_recursive(sub)
-    if x.tail is not None:
-        rv += x.tail + " "
-    return rv
+        if x.text is not None:
+            pieces.append(x.text)
+            pieces.append(" ")
+        if x.tail is not None:
+            stack.append(" ")
+            stack.append(x.tail)
+        stack.extend(reversed(x))
+    return "".join(pieces)
 
 
+# Yields (SECTNO text, SUBJECT text, flattened text, status, SECTNO text) for
+# every SECTION in the volume's TITLE, in document order, with None for a
+# missing SECTNO or SUBJECT and a status of "reserved" for sections marked
+# RESERVED.  (The SECTNO is both the key and the number.)  Streams the
+# file, so the whole tree is never held in memory.
+def TR_records_from_xml(path:str):
+    for outermost in utils.iterparse_outermost(path, "SECTION", within_tag="TITLE"):
+        for s in outermost.iter('SECTION'):
+            sectno = s.find("SECTNO")
+            subject = s.find("SUBJECT")
+            yield sectno.text if sectno is not None else None, \
+                  subject.text if subject is not None else None, \
+                  get_TR_text_recursive(s), \
+                  "reserved" if s.find("RESERVED") is not None else "", \
+                  sectno.text if sectno is not None else None
+
 
-# Load the Treas Regs
 # These XML files can be downloaded as a ZIP file from https://www.govinfo.gov/bulkdata/CFR/2020/title-26
-print("Loading Treas Regs: ", end="")
-tr_roots = []
-for filename in os.listdir("CFR-title-26"):
-    assert ".xml" in filename
-    tree = ET.parse("CFR-title-26/" + filename)
-    tr_roots.append((tree.getroot(), filename))
-    print(".", end="")
-print("")
-
-# sort the filenames numerically
-tr_roots.sort(key=lambda x: int(re.search("vol([1-9][0-9]?)[.]", x[1])[1]))
+TR_XML_DIR = "CFR-title-26"
+
+# Index from standardized section number (e.g., "1.61-1") to the list of
+# volume filenames containing it, read from a manifest kept with the corpus
+# cache.  The "§§" entries covering several sections are kept apart in
+# tr_multi_section_index, keyed by their standardized range (e.g.,
+# "1.61-3-1.61-4").  Both are built on first use, and each volume itself is
+# only loaded (into tr_volumes) once a section in it is asked for.
+tr_index = None
+tr_multi_section_index = None
+tr_volumes = {} # filename -> (corpus, {standardized section number: [record index]})
+
+
+# Returns the standardized section number of a SECTNO text and whether it is
+# one of the multi-section ("§§") portions
+def TR_section_key(s_num:str) -> (str, bool):
+    if s_num[:2] == "§§":
+        return utils.standardize(s_num[2:]), True
+    if s_num[0] == "§":
+        s_num = s_num[1:].strip()
+    return utils.standardize(s_num), False
+
+
+# Returns one volume and its index, read from the on-disk cache unless its
+# XML has changed, without touching the loaded volumes
+def read_TR_volume(filename:str) -> (corpuscache.CachedCorpus, dict):
+    corpus = corpuscache.load(TR_XML_DIR + "/" + filename, TR_records_from_xml)
+    volume_index = {}
+    for idx, s_num in enumerate(corpus.keys):
+        if s_num is not None:
+            volume_index.setdefault(TR_section_key(s_num), []).append(idx)
+    return corpus, volume_index
+
+
+# Loads one volume, from the on-disk cache unless its XML has changed
+def load_TR_volume(filename:str):
+    if filename not in tr_volumes:
+        tr_volumes[filename] = read_TR_volume(filename)
+    return tr_volumes[filename]
+
+
+# Returns the index and the multi-section index, as kept in tr_index and
+# tr_multi_section_index, from the manifest, updating the manifest first for
+# any volume that has changed.  Volumes read for that are added to volumes
+# (filename -> what read_TR_volume returns), and any already there are used.
+# Progress is printed to the progress file if given, else standard output.
+def read_TR_index(volumes:dict, progress = None) -> (dict, dict):
+    manifest = corpuscache.read_manifest(TR_XML_DIR)
+    new_manifest = {}
+    stale_volumes = []
+    for filename in os.listdir(TR_XML_DIR):
+        assert ".xml" in filename
+        signature = corpuscache.source_signature(TR_XML_DIR + "/" + filename)
+        if filename in manifest and manifest[filename]["signature"] == signature:
+            new_manifest[filename] = manifest[filename]
+        else:
+            stale_volumes.append(filename)
+    if len(stale_volumes) > 0:
+        print("Loading Treas Regs: ", end="", file=progress)
+        for filename in stale_volumes:
+            if filename not in volumes:
+                volumes[filename] = read_TR_volume(filename)
+            _, volume_index = volumes[filename]
+            new_manifest[filename] = {
+                "signature": corpuscache.source_signature(TR_XML_DIR + "/" + filename),
+                "sections": [[s_num, is_multi, len(idxs)] for (s_num, is_multi), idxs in volume_index.items()]}
+            print(".", end="", file=progress)
+        print("", file=progress)
+    if new_manifest != manifest:
+        corpuscache.write_manifest(TR_XML_DIR, new_manifest)
+
+    index, multi_section_index = {}, {}
+    for filename, entry in new_manifest.items():
+        for s_num, is_multi, count in entry["sections"]:
+            (multi_section_index if is_multi else index).setdefault(s_num, []).extend([filename] * count)
+    return index, multi_section_index
+
+
+def build_TR_index():
+    global tr_index, tr_multi_section_index
+    tr_index, tr_multi_section_index = read_TR_index(tr_volumes)
+
+
+# Loads the index and every volume holding one of the given section numbers,
+# e.g., ahead of forking worker processes that will look them up
+def preload_TR(sec_nums:list):
+    if tr_index is None:
+        build_TR_index()
+    for sec_num in sec_nums:
+        for filename in tr_index.get(utils.standardize(sec_num), []):
+            load_TR_volume(filename)
+
+
+# Returns (corpus, filename) for every volume, sorted numerically by filename
+def load_all_TR_volumes() -> list:
+    filenames = sorted(os.listdir(TR_XML_DIR),
+                       key=lambda f: int(re.search("vol([1-9][0-9]?)[.]", f)[1]))
+    return [(load_TR_volume(filename)[0], filename) for filename in filenames]
+
+
+# Forgets the loaded index and volumes, so that the next lookup loads them
+# again, e.g., after the volumes in TR_XML_DIR have changed on disk
+def unload_TR():
+    global tr_index, tr_multi_section_index
+    tr_index, tr_multi_section_index = None, None
+    tr_volumes.clear()
+
 
 debug_call_info = []
 
 
-# Returns a tuple of length of XML, length of Supp, number of recursive calls,
-# number of dynamic programming entries, number of ellipses
-def check_TreasReg(sec_num:str, supp_title_text:str, in_lines:list) -> (int, int, int, int):
+# Returns the section's standardized SUBJECT and text as cached from the XML,
+# or None if there is no such section
+def find_TreasReg_section(sec_num:str) -> (str, str):
+    sec_num = utils.standardize(sec_num)
+    if tr_index is None:
+        build_TR_index()
+    filenames = tr_index.get(sec_num, [])
+    assert len(filenames) <= 1, "Should be only one match"
+    if len(filenames) == 0:
+        return None
+    corpus, volume_index = load_TR_volume(filenames[0])
+    idx = volume_index[(sec_num, False)][0]
+    return corpus.heading(idx), corpus.text(idx)
 
-    # if not sec_num.startswith("1.263(a)-"):
-    #     print("SECTION TOO TIME CONSUMING; SKIPPED")
-    #     return (0,0,0,0,0,0)
+
+# Known typos in the official XML.  Wherever a section's text contains one
+# of these triggers, every occurrence of the old text in it is replaced with
+# the new, in this order.
+TR_XML_FIXES = {
+    "the unadjusted basis of the property in the hands of the son ins $90,000": ("son ins $90,000", "son is $90,000"),
+    "for sale to customers is includible in the empoyee": ("in the empoyee", "in the employee"),
+    "such difference included in gross income (ii)": ("in gross income (ii)", "in gross income. (ii)"),
+    "Capitalization with respect to intangible s": ("to intangible s", "to intangibles"),
+}
+
+# Sections whose XML puts spaces inside numbered paragraph markers, e.g. "( 1 )"
+TR_SPACED_NUMBER_SECTIONS = ["1.263(a)-3", "1.362-4", "1.336-2", "1.355-2"]
+
+
+# Returns the heading and text to check a section against, given them as
+# cached, with known typos in the official XML fixed
+def TR_xml_texts(sec_num:str, heading_text:str, section_text:str) -> (str, str):
+    sec_num = utils.standardize(sec_num)
+    xml_str = section_text
+    for trigger, (old, new) in TR_XML_FIXES.items():
+        if trigger in xml_str:
+            xml_str = xml_str.replace(old, new)
+    if sec_num in TR_SPACED_NUMBER_SECTIONS:
+        for i in range(1,10):
+            xml_str = xml_str.replace("( " + str(i)+ " )", "(" + str(i)+ ")")
+    # print("Raw XML:", ET.tostring(irc_sec)) # useful for debug
+    # print("XML text: ", re.sub("\n\\s*\n", "\n", xml_str)) # useful for debug
+    return heading_text, xml_str
+
+
+# Returns the section's standardized heading and text from the XML, with
+# known typos in the official XML fixed, or None if there is no such section
+def lookup_TreasReg(sec_num:str) -> (str, str):
+    section = find_TreasReg_section(sec_num)
+    if section is None:
+        return None
+    return TR_xml_texts(sec_num, *section)
+
+
+# Returns a tuple of length of XML, length of Supp, number of recursive calls,
+# number of dynamic programming entries, number of ellipses.  If report is
+# given, the verdict ("success", "failure", or "not found"), any heading
+# mismatch, and where any failure is are also put in it.
+def check_TreasReg(sec_num:str, supp_title_text:str, in_lines:list, report:dict = None) -> (int, int, int, int):
+    if report is None:
+        report = {}
 
     sec_num = utils.standardize(sec_num)
     print("-----------------------------------\nSection:", sec_num)
-    tr_sec = None
-    for r, filename in tr_roots:
-        content = r.find("TITLE")
-        for s in content.iter('SECTION'):
-            if s.find("SECTNO") is not None:
-                s_num = s.find("SECTNO").text
-                if s_num[:2] != "§§": # skip the multi-section portions
-                    if s_num[0] == "§":
-                        s_num = s_num[1:].strip()
-                    s_num = utils.standardize(s_num)
-                    if s_num == sec_num:
-                        assert tr_sec is None, "Should be only one match"
-                        tr_sec = s
-
-    if tr_sec is None:
+    xml_texts = lookup_TreasReg(sec_num)
+    if xml_texts is None:
         print("FAILED TO MATCH: ", sec_num, supp_title_text)
+        report["verdict"] = "not found"
         return (0,0,0,0,0,0)
+    xml_heading_text, xml_str = xml_texts
 
     # Check the title
-    xml_heading_text = utils.standardize(tr_sec.find('SUBJECT').text).strip().strip(".")
     supp_title_text = utils.standardize(supp_title_text).strip().strip(".")
     if xml_heading_text != supp_title_text:
         print("FAILED TO MATCH HEADER ", sec_num)
         print("XML  :", xml_heading_text)
         print("Supp.:", supp_title_text)
-
-    # gather the XML text
-    xml_str = utils.standardize(get_TR_text_recursive(tr_sec))
-    # print("Raw XML:", ET.tostring(irc_sec)) # useful for debug
-    # print("XML text: ", re.sub("\n\\s*\n", "\n", xml_str)) # useful for debug
-    xml_str = " ".join(xml_str.split()) # normalize whitespace
-
-    # fix known typos in the official XML
-    if "the unadjusted basis of the property in the hands of the son ins $90,000" in xml_str:
-        xml_str = xml_str.replace("son ins $90,000", "son is $90,000")
-    if "for sale to customers is includible in the empoyee" in xml_str:
-        xml_str = xml_str.replace("in the empoyee", "in the employee")
-    if "such difference included in gross income (ii)" in xml_str:
-        xml_str = xml_str.replace("in gross income (ii)", "in gross income. (ii)")
-    if "Capitalization with respect to intangible s" in xml_str:
-        xml_str = xml_str.replace("to intangible s", "to intangibles")
-    if sec_num == "1.263(a)-3" or sec_num == "1.362-4" or sec_num == "1.336-2" or sec_num == "1.355-2":
-        for i in range(1,10):
-            xml_str = xml_str.replace("( " + str(i)+ " )", "(" + str(i)+ ")")
+        report["heading_mismatch"] = {"xml": xml_heading_text, "supp": supp_title_text}
 
     supp_str = utils.process_supp_lines(in_lines, sec_num)
 
     dual_indexes_tried = {}
     fail_start_idx_ellipsis = {}
-    result, num_recursive_calls = \
-        utils.recursive_match(supp_str, 0, xml_str, 0, dual_indexes_tried, fail_start_idx_ellipsis) # actual function call
+    result, num_recursive_calls, furthest, budget_limited = \
+        utils.budgeted_match(supp_str, xml_str, dual_indexes_tried, fail_start_idx_ellipsis) # actual function call
+    if budget_limited:
+        print("BUDGET-LIMITED: matching went over budget, so the result below is only approximate")
+        report["budget_limited"] = True
 
     if not result:
-        print("TREAS REG FAILURE", sec_num)
-        utils.find_error(supp_str, xml_str)
+        print("TREAS REG FAILURE", sec_num + (" (BUDGET-LIMITED)" if budget_limited else ""))
+        report["verdict"] = "failure"
+        report["failure"] = utils.find_error(supp_str, xml_str, furthest)
         print("XML string:", xml_str)
         # print("Raw XML:", ET.tostring(tr_sec)) # useful for debug
         # print("here")
     else:
-        print("TREAS REG SUCCESS", sec_num)
+        print("TREAS REG SUCCESS", sec_num + (" (BUDGET-LIMITED)" if budget_limited else ""))
+        report["verdict"] = "success"
 
     return len(xml_str), len(supp_str), \
            num_recursive_calls, len(dual_indexes_tried), \
@@ -122,31 +275,26 @@ if __name__ == '__main__':
     section_count = 0 # only counts non-reserved sections
     word_count = 0
     reserved_count = 0 # number of sections listed as reserved
-    for idx, (r, filename) in enumerate(tr_roots):
+    for idx, (corpus, filename) in enumerate(load_all_TR_volumes()):
         print("******************", idx, filename)
-        content = r.find("TITLE")
-        for s in content.iter('SECTION'):
-            # if s.find("SUBJECT") is not None:
-            #     print(s.find("SUBJECT").text, end=" ")
-            if s.find("RESERVED") is not None:
-                reserved_count += 1
-            elif s.find("SECTNO") is not None:
-                print(s.find("SECTNO").text)
-                section_count += 1
-                section_title = utils.standardize(s.find('SUBJECT').text).strip().strip(".")
-                word_count += len(section_title.split())
-                section_text = utils.standardize(get_TR_text_recursive(s))
-                word_count += len(section_text.split())
+        for sec_idx, sectno_text in enumerate(corpus.keys):
+            if sectno_text is not None and not corpus.flags[sec_idx] & corpuscache.RESERVED:
+                print(sectno_text)
                 # The code below is used to print out a single section's text and stats.
                 # If you paste the printed text into a Microsoft Word document, you see
                 # that the word counts match.
-                if s.find("SECTNO").text[2:] == "1.61-2":
-                    print(section_title)
-                    print("Got total", len(section_title.split()))
-                    print(section_text)
-                    print("Got total", len(section_text.split()))
+                if sectno_text[2:] == "1.61-2":
+                    print(corpus.heading(sec_idx))
+                    print("Got total", corpus.num_heading_words(sec_idx))
+                    print(corpus.text(sec_idx))
+                    print("Got total", corpus.num_words(sec_idx))
+
+        reserved_count += corpus.totals(require=corpuscache.RESERVED)[0]
+        num_sections, text_words, heading_words = \
+            corpus.totals(require=corpuscache.HAS_KEY, exclude=corpuscache.RESERVED)
+        section_count += num_sections
+        word_count += text_words + heading_words
 
     print("Total sections =", section_count)
     print("Total reserved sections =", reserved_count)
     print("Total words =", word_count)
-
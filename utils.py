@@ -2,46 +2,120 @@
 # throughout the IRC and CFR verification
 import re
 import string
+import time
+import xml.etree.ElementTree as ET
 
-hyphen_lookalikes_re = re.compile(r"[−—–]") # em-dashes and en-dashes
+# em-dashes and en-dashes become hyphens, and curly quotes become straight ones
+lookalikes = {"−": "-", "—": "-", "–": "-", "“": "\"", "”": "\"", "’": "'", "‘": "'"}
+lookalikes_re = re.compile("[" + "".join(lookalikes) + "]")
+
+# Folds dashes and quotes, turns "--" into "-", and collapses whitespace.
+# The lookalikes are folded in one pass, skipped for ASCII text, which cannot
+# contain any.  (Doing it all in one regular expression pass is much slower,
+# as the regular expression engine steps through every character while these
+# string methods do not.)
 def standardize(s:str) -> str:
-    rv = hyphen_lookalikes_re.sub("-", s).replace("--", "-")
-    rv = rv.replace("“", "\"").replace("”", "\"").replace("’", "'").replace("‘", "'")
-    return " ".join(rv.split())
+    if not s.isascii():
+        s = lookalikes_re.sub(lambda m: lookalikes[m.group()], s)
+    return " ".join(s.replace("--", "-").split())
+
+# Streams the XML file at path with iterparse, yielding each outermost element
+# with the given tag (any nested ones stay inside it) once its tail has been
+# parsed too.  Once the caller moves on, the element is cleared and detached,
+# as is every element that ends outside such an element, so memory stays flat
+# no matter how large the file is.  If within_tag is given, only the elements
+# inside the first child of the root with that tag are yielded.
+def iterparse_outermost(path:str, tag:str, within_tag:str = None):
+    open_elements = []
+    num_open_with_tag = 0
+    within_elem = None
+    inside_within = within_tag is None
+    pending, pending_parent = None, None # yielded once its tail is known
+    for event, elem in ET.iterparse(path, events=("start", "end")):
+        if pending is not None:
+            # the parser only sets an element's tail when it reaches the next tag
+            yield pending
+            pending.clear()
+            if pending_parent is not None:
+                pending_parent.remove(pending)
+            pending = None
+
+        if event == "start":
+            if elem.tag == tag:
+                num_open_with_tag += 1
+            if within_tag is not None and within_elem is None and \
+                    len(open_elements) == 1 and elem.tag == within_tag:
+                within_elem = elem
+                inside_within = True
+            open_elements.append(elem)
+            continue
+
+        open_elements.pop()
+        parent = open_elements[-1] if len(open_elements) > 0 else None
+        if elem.tag == tag:
+            num_open_with_tag -= 1
+            if num_open_with_tag == 0 and inside_within:
+                pending, pending_parent = elem, parent
+                continue
+        if elem is within_elem:
+            inside_within = False
+        if num_open_with_tag == 0 and parent is not None:
+            elem.clear() # nothing outside the yielded elements is needed
+            parent.remove(elem)
+    if pending is not None:
+        yield pending
 
-def recursive_match(supp_str:str, supp_idx_start:int,
-                        xml_str:str, xml_idx_start:int, 
-                        dual_indexes_tried:dict, fail_start_idx_ellipsis:dict) -> (bool, int):
-    num_recursive_calls = 1 # will be returned; used for performance and debug
 
-    supp_idx = supp_idx_start
-    xml_idx = xml_idx_start
+# Takes one step over a known harmless difference between the supplement and
+# the XML at the given indexes, where their characters differ, and returns
+# the indexes after it, or None if the difference is a real mismatch
+def skip_step(supp_str:str, supp_idx:int, xml_str:str, xml_idx:int):
+    if supp_str[supp_idx:supp_idx+2] == ". " and xml_str[xml_idx:xml_idx+1] == " ":
+        return supp_idx + 1, xml_idx # handle the mysterious missing periods in XML version
+    # elif supp_str[supp_idx:supp_idx+2] == ", " and xml_str[xml_idx:xml_idx+3] == " , ":
+    #     xml_idx += 1 # handle the mysterious extra space before commas in the XML
+    elif supp_str[supp_idx:supp_idx+2] == " …":
+        return supp_idx + 1, xml_idx
+    elif supp_str[supp_idx:supp_idx+1].isspace() and xml_str[xml_idx:xml_idx+1] in ["-", "("]: # advance over extra spaces added
+        return supp_idx + 1, xml_idx
+    elif xml_str[xml_idx:xml_idx+1].isspace() and supp_str[supp_idx:supp_idx+1] in string.punctuation : # advance over extra spaces added
+        return supp_idx, xml_idx + 1
+    return None
 
-    while True:  # main loop to advance as far as possible
+
+# Advances through supp_str and xml_str from the given indexes for as long as
+# they match, allowing for the known harmless differences between the
+# supplement and the XML, and returns the indexes where matching stopped
+def advance_match(supp_str:str, supp_idx:int, xml_str:str, xml_idx:int) -> (int, int):
+    while supp_idx < len(supp_str) and xml_idx < len(xml_str):
         # if supp_idx > 940:
         #     print("", end="")
         # if supp_str[supp_idx:].startswith("for any taxable year beginning after"):
         #     assert True
 
-        if supp_idx == len(supp_str) and xml_idx == len(xml_str):
-            return True, num_recursive_calls # then we have matched
-        elif supp_idx == len(supp_str) or xml_idx == len(xml_str):
-            return False, num_recursive_calls # then only one matched
         if supp_str[supp_idx] == xml_str[xml_idx]: # exact match => advance both
             supp_idx += 1
             xml_idx += 1
-        elif supp_str[supp_idx:supp_idx+2] == ". " and xml_str[xml_idx:xml_idx+1] == " ":
-            supp_idx += 1 # handle the mysterious missing periods in XML version
-        # elif supp_str[supp_idx:supp_idx+2] == ", " and xml_str[xml_idx:xml_idx+3] == " , ":
-        #     xml_idx += 1 # handle the mysterious extra space before commas in the XML
-        elif supp_str[supp_idx:supp_idx+2] == " …":
-            supp_idx += 1
-        elif supp_str[supp_idx:supp_idx+1].isspace() and xml_str[xml_idx:xml_idx+1] in ["-", "("]: # advance over extra spaces added
-            supp_idx += 1
-        elif xml_str[xml_idx:xml_idx+1].isspace() and supp_str[supp_idx:supp_idx+1] in string.punctuation : # advance over extra spaces added
-            xml_idx += 1
         else:
-            break # then we need to consider the next possibilities
+            skipped = skip_step(supp_str, supp_idx, xml_str, xml_idx)
+            if skipped is None:
+                break # then we need to consider the next possibilities
+            supp_idx, xml_idx = skipped
+    return supp_idx, xml_idx
+
+
+# The original exhaustive matcher, which tries every XML offset after each
+# ellipsis.  Kept as the reference that ellipsis_match is checked against.
+def recursive_match(supp_str:str, supp_idx_start:int,
+                        xml_str:str, xml_idx_start:int, 
+                        dual_indexes_tried:dict, fail_start_idx_ellipsis:dict) -> (bool, int):
+    num_recursive_calls = 1 # will be returned; used for performance and debug
+
+    supp_idx, xml_idx = advance_match(supp_str, supp_idx_start, xml_str, xml_idx_start)
+    if supp_idx == len(supp_str) and xml_idx == len(xml_str):
+        return True, num_recursive_calls # then we have matched
+    elif supp_idx == len(supp_str) or xml_idx == len(xml_str):
+        return False, num_recursive_calls # then only one matched
 
     # skip over ellipses
     if supp_str[supp_idx:supp_idx+1] == "…":
@@ -76,38 +150,284 @@ def recursive_match(supp_str:str, supp_idx_start:int,
     return False, num_recursive_calls # we couldn't find a good match
 
 
+# Returns the first XML offset at or after xml_idx at which the supplement
+# text starting at supp_idx could possibly match, or None if there is none.
+# An exact match needs the same first character, except where the XML drops
+# a period before a space.  (Extra XML spaces before punctuation are skipped
+# by advance_match, so matching there is the same as matching just after.)
+def next_anchor(supp_str:str, supp_idx:int, xml_str:str, xml_idx:int):
+    if xml_idx > len(xml_str):
+        return None
+    if supp_idx == len(supp_str):
+        return len(xml_str) # an empty final segment can only match the very end
+    c = supp_str[supp_idx]
+    if c == "…" or c.isspace():
+        return xml_idx
+    anchor = xml_str.find(c, xml_idx)
+    if supp_str[supp_idx:supp_idx+2] == ". ":
+        space_anchor = xml_str.find(" ", xml_idx)
+        if space_anchor >= 0 and (anchor < 0 or space_anchor < anchor):
+            anchor = space_anchor
+    return anchor if anchor >= 0 else None
+
+
+# The budget for matching any one section: the seconds it may take and the
+# number of (segment start, XML offset) pairs it may try, with None for no
+# limit.  A section over budget is matched approximately instead.
+MATCH_TIME_BUDGET = 10.0
+MATCH_MEMO_BUDGET = 1000000
+
+# Characters at the start of a segment that approximate_match searches for
+PROBE_CHARS = 30
+
+
+class MatchBudgetExceeded(Exception):
+    pass
+
+
+# Returns the first XML offset, at or after xml_start, from which
+# advance_match carries the supplement text from supp_idx right to the end of
+# both strings (or None if there is none), and the earliest (supplement
+# index, XML index) from which it does so.  Rather than running
+# advance_match from every offset, this works back from the ends: each
+# position is stepped into from at most three others, so only the positions
+# that actually lead to the ends are visited, which is close to linear in the
+# length of the segment.  Raises MatchBudgetExceeded as ellipsis_match does.
+def final_anchor(supp_str:str, supp_idx:int, xml_str:str, xml_start:int,
+                 deadline:float = None, max_memo:int = None) -> (int, (int, int)):
+    if xml_start > len(xml_str):
+        return None, (len(supp_str), len(xml_str))
+    anchor, earliest = None, (len(supp_str), len(xml_str))
+    pending = [earliest]
+    num_visited = 0
+    while len(pending) > 0:
+        i, j = pending.pop()
+        num_visited += 1
+        if num_visited % 4096 == 0 and \
+                ((deadline is not None and time.perf_counter() > deadline) or
+                 (max_memo is not None and num_visited >= max_memo)):
+            raise MatchBudgetExceeded()
+        if (i, j) < earliest:
+            earliest = (i, j)
+        if i == supp_idx and (anchor is None or j < anchor):
+            anchor = j
+        for prev_i, prev_j in [(i-1, j-1), (i-1, j), (i, j-1)]:
+            if prev_i < supp_idx or prev_j < xml_start or prev_i >= len(supp_str) or prev_j >= len(xml_str):
+                continue
+            if supp_str[prev_i] == xml_str[prev_j]:
+                step = (prev_i + 1, prev_j + 1)
+            else:
+                step = skip_step(supp_str, prev_i, xml_str, prev_j)
+            if step == (i, j):
+                pending.append((prev_i, prev_j))
+    return anchor, earliest
+
+
+# Matches the final segment of supp_str, from supp_idx, against the XML from
+# any offset at or after xml_start up to the end, for ellipsis_match, which
+# passes in its num_attempts and furthest so far.  On failure, the furthest
+# is the furthest that running the segment forward reaches, as for any other
+# segment.  It is run from the first place its start occurs, then from each
+# anchor in turn, until the characters compared come to a few times the
+# length of the text left, so that this stays close to linear (where the
+# segment matches a long way at very many anchors, they all stop at much the
+# same place).  Only if there is no anchor at all is the furthest where the
+# segment stops matching back from the end.
+def final_match(supp_str:str, supp_idx:int, xml_str:str, xml_start:int,
+                dual_indexes_tried:dict, fail_start_idx_ellipsis:dict, deadline:float, max_memo:int,
+                num_attempts:int, furthest:(int, int)) -> (bool, int, (int, int)):
+    num_attempts += 1
+    anchor, earliest = final_anchor(supp_str, supp_idx, xml_str, xml_start, deadline, max_memo)
+    if anchor is not None:
+        dual_indexes_tried[(supp_idx, anchor)] = True
+        return True, num_attempts, (len(supp_str), len(xml_str))
+    fail_start_idx_ellipsis[supp_idx] = xml_start
 
-def find_error(supp_str:str, xml_str:str):
-    idx_known_bad = len(supp_str) # we know full is not a good match
-    idx_known_good = 0 # we know zero will be a good match
-    while idx_known_good < idx_known_bad-1:
-        # print("Searching for Error,  idx_known_good=", idx_known_good, " idx_known_bad=",idx_known_bad)
-        idx_to_try = int((idx_known_good+idx_known_bad)/2) # basically binary search
-        dual_indexes_tried = {}
-        fail_start_idx_ellipsis = {}
-        str_to_try = supp_str[:idx_to_try]+"…"
-        # print("Trying:", str_to_try)
-        success, _ = recursive_match(str_to_try, 0, xml_str, 0, \
-                                  dual_indexes_tried, fail_start_idx_ellipsis)
-        # print("success =", success)
-        if success:
-            idx_known_good = idx_to_try
+    probe = supp_str[supp_idx:supp_idx + PROBE_CHARS].strip()
+    probe_anchor = xml_str.find(probe, xml_start) if probe != "" else -1
+    candidates = [probe_anchor] if probe_anchor >= 0 else []
+    work_left = 4 * (len(supp_str) - supp_idx + len(xml_str) - xml_start)
+    segment_furthest = None
+    anchor = xml_start
+    while work_left > 0:
+        if len(candidates) > 0:
+            candidate = candidates.pop()
         else:
-            idx_known_bad = idx_to_try
-    assert idx_known_good == idx_known_bad-1
-    print("PROBLEM at ", supp_str[max(0,idx_known_good-40):idx_known_good], "<-->", supp_str[idx_known_bad-1:idx_known_bad+25])
-    # print(" FULL CONTEXT ", supp_str[idx_known_good-400:idx_known_good+1], "<-->", supp_str[idx_known_bad:idx_known_bad+400])
+            anchor = next_anchor(supp_str, supp_idx, xml_str, anchor)
+            if anchor is None:
+                break
+            candidate = anchor
+            anchor += 1
+        if (supp_idx, candidate) in dual_indexes_tried:
+            continue
+        num_attempts += 1
+        supp_end, xml_end = advance_match(supp_str, supp_idx, xml_str, candidate)
+        dual_indexes_tried[(supp_idx, candidate)] = False
+        work_left -= supp_end - supp_idx + 1
+        if segment_furthest is None or supp_end > segment_furthest[0]:
+            segment_furthest = (supp_end, xml_end)
+    if segment_furthest is None:
+        segment_furthest = earliest # nowhere for the segment to start
+    if segment_furthest[0] > furthest[0]:
+        furthest = segment_furthest
+    return False, num_attempts, furthest
+
+
+# Matches supp_str against xml_str, where each ellipsis in supp_str stands
+# for one or more characters of xml_str.  Works iteratively, one literal
+# segment (the text between ellipses) at a time: each segment is anchored at
+# the first XML offset where it matches up to the next ellipsis, which leaves
+# as much XML as possible for the segments after it, and is never revisited.
+# The final segment must instead match right up to the end of the XML, so
+# it is matched back from the end by final_match.  This gives the same
+# answer as recursive_match without ever backtracking over a segment.  Each
+# other segment is still run forward from one anchor after another, though,
+# so one that matches a long way from each of many anchors before failing
+# takes time proportional to the segment's length times the number of
+# anchors (the long-middle-segment cases in benchmark.py track this).
+# Returns success, the number of segment matches attempted, and the furthest
+# (supplement index, XML index) that matching reached, which is where any
+# error is.  Also records each (segment start, XML offset) tried in
+# dual_indexes_tried and each ellipsis that could not be matched at all in
+# fail_start_idx_ellipsis.  Raises MatchBudgetExceeded once past the deadline
+# (a time.perf_counter() value) or once more than max_memo pairs are tried.
+def ellipsis_match(supp_str:str, xml_str:str,
+                   dual_indexes_tried:dict, fail_start_idx_ellipsis:dict,
+                   deadline:float = None, max_memo:int = None) -> (bool, int, (int, int)):
+    num_attempts = 1
+    supp_idx, xml_idx = advance_match(supp_str, 0, xml_str, 0)
+    furthest = (supp_idx, xml_idx)
+
+    while True:
+        if supp_idx == len(supp_str) and xml_idx == len(xml_str):
+            return True, num_attempts, furthest # then we have matched
+        elif supp_idx == len(supp_str) or xml_idx == len(xml_str) or \
+                supp_str[supp_idx] != "…":
+            return False, num_attempts, furthest # then only one matched, or a real mismatch
+
+        supp_idx += 1 # skip over ellipsis
+        if supp_str[supp_idx:supp_idx+1].isspace():
+            supp_idx += 1 # skip over spaces after ellipses
+
+        if supp_str.find("…", supp_idx) < 0:
+            return final_match(supp_str, supp_idx, xml_str, xml_idx + 1, dual_indexes_tried,
+                               fail_start_idx_ellipsis, deadline, max_memo, num_attempts, furthest)
+
+        anchor = xml_idx + 1 # an ellipsis stands for at least one character
+        while True:
+            anchor = next_anchor(supp_str, supp_idx, xml_str, anchor)
+            if anchor is None:
+                fail_start_idx_ellipsis[supp_idx] = xml_idx + 1
+                return False, num_attempts, furthest
+            if (deadline is not None and time.perf_counter() > deadline) or \
+                    (max_memo is not None and len(dual_indexes_tried) >= max_memo):
+                raise MatchBudgetExceeded()
+            num_attempts += 1
+            supp_end, xml_end = advance_match(supp_str, supp_idx, xml_str, anchor)
+            if supp_end > furthest[0]:
+                furthest = (supp_end, xml_end)
+            reached_end = supp_end == len(supp_str) and xml_end == len(xml_str)
+            reached_ellipsis = supp_end < len(supp_str) and xml_end < len(xml_str) and \
+                               supp_str[supp_end] == "…"
+            dual_indexes_tried[(supp_idx, anchor)] = reached_end or reached_ellipsis
+            if reached_end or reached_ellipsis:
+                break
+            anchor += 1
+        supp_idx, xml_idx = supp_end, xml_end
+
+
+# Returns where a failed match went wrong, given the furthest (supplement
+# index, XML index) that ellipsis_match reached, as a dict of those indexes
+# and the context on both sides of each
+def error_context(supp_str:str, xml_str:str, furthest:(int, int)) -> dict:
+    supp_idx, xml_idx = furthest
+    return {"supp_idx": supp_idx, "xml_idx": xml_idx,
+            "supp_before": supp_str[max(0,supp_idx-40):supp_idx], "supp_after": supp_str[supp_idx:supp_idx+26],
+            "xml_before": xml_str[max(0,xml_idx-40):xml_idx], "xml_after": xml_str[xml_idx:xml_idx+26]}
+
+
+# A cheaper, approximate version of ellipsis_match, for sections over budget.
+# Each literal segment is only tried at the first place its start (up to
+# PROBE_CHARS characters) occurs after the previous segment, found by
+# str.find, and else at its first possible anchor; the final segment is
+# tried at the last place its start occurs instead.  So any accepted match is
+# a real one, but a section can be rejected that ellipsis_match would accept.
+# Returns the same as ellipsis_match.
+def approximate_match(supp_str:str, xml_str:str) -> (bool, int, (int, int)):
+    num_attempts = 1
+    supp_idx, xml_idx = advance_match(supp_str, 0, xml_str, 0)
+    furthest = (supp_idx, xml_idx)
+
+    while True:
+        if supp_idx == len(supp_str) and xml_idx == len(xml_str):
+            return True, num_attempts, furthest
+        elif supp_idx == len(supp_str) or xml_idx == len(xml_str) or \
+                supp_str[supp_idx] != "…":
+            return False, num_attempts, furthest
+
+        supp_idx += 1 # skip over ellipsis
+        if supp_str[supp_idx:supp_idx+1].isspace():
+            supp_idx += 1 # skip over spaces after ellipses
+
+        segment_end = supp_str.find("…", supp_idx)
+        is_final = segment_end < 0
+        if is_final:
+            segment_end = len(supp_str)
+        probe = supp_str[supp_idx:min(segment_end, supp_idx + PROBE_CHARS)].strip()
+        if is_final:
+            anchors = [xml_str.rfind(probe, xml_idx + 1)]
+        else:
+            anchors = [xml_str.find(probe, xml_idx + 1)]
+        anchors.append(next_anchor(supp_str, supp_idx, xml_str, xml_idx + 1))
+
+        for anchor in dict.fromkeys(a for a in anchors if a is not None and a >= 0):
+            num_attempts += 1
+            supp_end, xml_end = advance_match(supp_str, supp_idx, xml_str, anchor)
+            if supp_end > furthest[0]:
+                furthest = (supp_end, xml_end)
+            if (supp_end == len(supp_str) and xml_end == len(xml_str)) or \
+                    (supp_end < len(supp_str) and xml_end < len(xml_str) and supp_str[supp_end] == "…"):
+                break
+        else:
+            return False, num_attempts, furthest
+        supp_idx, xml_idx = supp_end, xml_end
+
+
+# Matches supp_str against xml_str with ellipsis_match, within the budget of
+# MATCH_TIME_BUDGET and MATCH_MEMO_BUDGET, falling back on approximate_match
+# for a section over budget.  Returns the same as ellipsis_match, plus
+# whether the section was over budget.
+def budgeted_match(supp_str:str, xml_str:str,
+                   dual_indexes_tried:dict, fail_start_idx_ellipsis:dict) -> (bool, int, (int, int), bool):
+    deadline = None if MATCH_TIME_BUDGET is None else time.perf_counter() + MATCH_TIME_BUDGET
+    try:
+        return ellipsis_match(supp_str, xml_str, dual_indexes_tried, fail_start_idx_ellipsis,
+                              deadline, MATCH_MEMO_BUDGET) + (False,)
+    except MatchBudgetExceeded:
+        return approximate_match(supp_str, xml_str) + (True,)
+
+
+# Prints where a failed match went wrong, given the furthest (supplement
+# index, XML index) that ellipsis_match reached, with the context on both
+# sides, and returns the error_context
+def find_error(supp_str:str, xml_str:str, furthest:(int, int)) -> dict:
+    context = error_context(supp_str, xml_str, furthest)
+    print("PROBLEM at ", context["supp_before"], "<-->", context["supp_after"])
+    print("   XML at ", context["xml_before"], "<-->", context["xml_after"])
+    # print(" FULL CONTEXT ", supp_str[furthest[0]-400:furthest[0]+1], "<-->", supp_str[furthest[0]:furthest[0]+400])
+    return context
+
 
+supp_comment_re = re.compile(r"\s?\[[^\]]+\]")
 
 def process_supp_lines(in_lines:list, sec_num:str) -> str:
     # gather the supplement text
-    supp_str = ""
-    for i in range(1, len(in_lines)):
-        supp_str += in_lines[i] + " "
+    supp_str = " ".join(in_lines[1:])
     supp_str = supp_str.replace("...", "…") # standardize ellipses
     supp_str = supp_str.replace("[]", "…") # standardize [] into an ellipse (equivalent!)
-    supp_str = re.sub("(\s?\[)([^\]]+)(\])", "", supp_str) # remove comments
+    if "[" in supp_str:
+        supp_str = supp_comment_re.sub("", supp_str) # remove comments
     supp_str = " ".join(supp_str.split()) # normalize whitespace
     if sec_num == "1231" and supp_str[-1:] == "7": # handles the weird extra character
         supp_str = supp_str[:-1].strip()
-    return supp_str
\ No newline at end of file
+    return supp_str
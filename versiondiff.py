@@ -0,0 +1,170 @@
+# Compares two releases of the official XML (an old and a new usc26.xml,
+# and/or an old and a new CFR-title-26 directory), lists the sections whose
+# text changed, and re-checks only the sections of the supplement whose
+# official text changed, against the new release, each with a word-level
+# diff of the change.
+#
+# Sections are compared by a digest of their standardized text, taken from
+# the corpus cache, so a new release costs one parse of the new XML (as any run
+# would) plus a pass over the cached texts, and only the changed sections
+# are matched against the supplement.
+#
+#   python versiondiff.py --old-irc usc26-2021.xml [--new-irc usc26.xml]
+#                         [--old-tr CFR-2020-title-26] [--new-tr CFR-title-26]
+#                         ["Code & Regs.txt" ...]
+
+import argparse
+import difflib
+import hashlib
+import os
+
+import codecheck, corpuscache, irc, treasregs, utils
+
+# Words of unchanged text shown on each side of a change
+DIFF_CONTEXT_WORDS = 6
+
+
+# Returns {IRC section number: (corpus, record index)} for the IRC at path
+def IRC_sections(path:str) -> dict:
+    corpus = corpuscache.load(path, irc.IRC_records_from_xml)
+    sections = {}
+    for idx, identifier in enumerate(corpus.keys):
+        if identifier is not None and identifier.startswith("/us/usc/t26/s"):
+            sections.setdefault(identifier[len("/us/usc/t26/s"):].lower(), (corpus, idx))
+    return sections
+
+
+# Returns {standardized Treas Reg section number: (corpus, record index)} for
+# every volume in the directory at path.  The "§§" portions covering several
+# sections are left out, as the checker never looks them up.
+def TR_sections(path:str) -> dict:
+    sections = {}
+    for filename in sorted(os.listdir(path)):
+        corpus = corpuscache.load(path + "/" + filename, treasregs.TR_records_from_xml)
+        for idx, sectno_text in enumerate(corpus.keys):
+            if sectno_text is not None:
+                s_num, is_multi = treasregs.TR_section_key(sectno_text)
+                if not is_multi:
+                    sections.setdefault(s_num, (corpus, idx))
+    return sections
+
+
+# Returns a digest of a section's heading and text
+def section_digest(corpus:corpuscache.CachedCorpus, idx:int) -> str:
+    return hashlib.sha256(((corpus.heading(idx) or "") + "\0" + corpus.text(idx)).encode("utf-8")).hexdigest()
+
+
+# Returns the standardized heading and text to check an IRC section against
+def IRC_section_texts(corpus:corpuscache.CachedCorpus, idx:int) -> (str, str):
+    return corpus.heading(idx) or "", corpus.text(idx)
+
+
+# Returns the standardized heading and text, with known typos fixed, to check
+# a Treas Reg section against
+def TR_section_texts(sec_num:str, corpus:corpuscache.CachedCorpus, idx:int) -> (str, str):
+    return treasregs.TR_xml_texts(sec_num, corpus.heading(idx) or "", corpus.text(idx))
+
+
+# Returns the section numbers that were changed, added, and removed between
+# the old and new sections, each sorted
+def changed_sections(old_sections:dict, new_sections:dict) -> (list, list, list):
+    changed = [sec_num for sec_num in new_sections if sec_num in old_sections and
+               section_digest(*old_sections[sec_num]) != section_digest(*new_sections[sec_num])]
+    added = [sec_num for sec_num in new_sections if sec_num not in old_sections]
+    removed = [sec_num for sec_num in old_sections if sec_num not in new_sections]
+    return sorted(changed), sorted(added), sorted(removed)
+
+
+def print_changes(title:str, changed:list, added:list, removed:list):
+    print(title, "changed =", len(changed), "  added =", len(added), "  removed =", len(removed))
+    for label, sec_nums in [("Changed:", changed), ("Added:  ", added), ("Removed:", removed)]:
+        if len(sec_nums) > 0:
+            print("  ", label, ", ".join(sec_nums))
+
+
+# Prints the change in the heading, if any, and the words of the text that
+# were removed (-) and added (+), with a few unchanged words around each change
+def print_word_diff(old_texts:(str, str), new_texts:(str, str)):
+    (old_heading_text, old_str), (new_heading_text, new_str) = old_texts, new_texts
+    if old_heading_text != new_heading_text:
+        print("   heading -", old_heading_text)
+        print("   heading +", new_heading_text)
+    old_words = old_str.split()
+    new_words = new_str.split()
+    matcher = difflib.SequenceMatcher(None, old_words, new_words, autojunk=False)
+    num_changes = 0
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op == "equal":
+            continue
+        num_changes += 1
+        print("   at:", "…", " ".join(old_words[max(0, i1-DIFF_CONTEXT_WORDS):i1]))
+        if i2 > i1:
+            print("    -", " ".join(old_words[i1:i2]))
+        if j2 > j1:
+            print("    +", " ".join(new_words[j1:j2]))
+        print("   then:", " ".join(new_words[j2:j2+DIFF_CONTEXT_WORDS]), "…")
+    if num_changes == 0 and old_heading_text == new_heading_text:
+        print("   (only whitespace changed)")
+
+
+# Re-checks, against the new release, each section of the supplement whose
+# official text changed, after printing the word-level diff of the change,
+# and returns the perf_data
+def recheck_supplement(path:str, changed_irc:dict, changed_tr:dict) -> list:
+    perf_data = []
+    with open(path, "r") as f:
+        for header, lines in codecheck.iter_sections(f):
+            in_lines = [header] + lines
+            sec_num, _, kind = codecheck.parse_header([utils.standardize(l) for l in in_lines])
+            if kind == "irc" and sec_num.lower() in changed_irc:
+                (old_corpus, old_idx), (new_corpus, new_idx) = changed_irc[sec_num.lower()]
+                print("===================================\nOfficial text changed:", sec_num)
+                print_word_diff(IRC_section_texts(old_corpus, old_idx), IRC_section_texts(new_corpus, new_idx))
+            elif kind == "treasreg" and utils.standardize(sec_num) in changed_tr:
+                sec_num = utils.standardize(sec_num)
+                (old_corpus, old_idx), (new_corpus, new_idx) = changed_tr[sec_num]
+                print("===================================\nOfficial text changed:", sec_num)
+                print_word_diff(TR_section_texts(sec_num, old_corpus, old_idx),
+                                TR_section_texts(sec_num, new_corpus, new_idx))
+            else:
+                continue
+            codecheck.check_lines(in_lines, perf_data)
+    return perf_data
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Lists the sections whose official text changed between "
+                                                 "two releases of the XML, and re-checks just those "
+                                                 "sections of the supplement against the new release.")
+    parser.add_argument("supplements", nargs="*", default=["Code & Regs.txt"],
+                        help="the supplements to re-check (default: Code & Regs.txt)")
+    parser.add_argument("--old-irc", help="the old release of usc26.xml")
+    parser.add_argument("--new-irc", default=irc.IRC_XML_PATH,
+                        help="the new release of usc26.xml (default: %(default)s)")
+    parser.add_argument("--old-tr", help="the directory of the old release of the CFR title 26 volumes")
+    parser.add_argument("--new-tr", default=treasregs.TR_XML_DIR,
+                        help="the directory of the new release of the CFR title 26 volumes (default: %(default)s)")
+    args = parser.parse_args()
+    if args.old_irc is None and args.old_tr is None:
+        parser.error("give --old-irc, --old-tr, or both")
+
+    # The checks are run against the new release
+    irc.IRC_XML_PATH = args.new_irc
+    treasregs.TR_XML_DIR = args.new_tr
+
+    changed_irc = {}
+    if args.old_irc is not None:
+        old_sections, new_sections = IRC_sections(args.old_irc), IRC_sections(args.new_irc)
+        changed, added, removed = changed_sections(old_sections, new_sections)
+        print_changes("IRC sections:", changed, added, removed)
+        changed_irc = {sec_num: (old_sections[sec_num], new_sections[sec_num]) for sec_num in changed}
+    changed_tr = {}
+    if args.old_tr is not None:
+        old_sections, new_sections = TR_sections(args.old_tr), TR_sections(args.new_tr)
+        changed, added, removed = changed_sections(old_sections, new_sections)
+        print_changes("Treas Reg sections:", changed, added, removed)
+        changed_tr = {sec_num: (old_sections[sec_num], new_sections[sec_num]) for sec_num in changed}
+
+    for path in codecheck.supplement_paths(args.supplements):
+        print("###################################\nSupplement:", path)
+        codecheck.print_perf_data(recheck_supplement(path, changed_irc, changed_tr))